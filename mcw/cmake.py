@@ -1,16 +1,57 @@
 import os
+import re
 import sys
-import pickle
+import shlex
 import pathlib
 import logging
+import logging.handlers
 import json
 import xml.etree.ElementTree as ETree
+from concurrent.futures import ThreadPoolExecutor
 
 from .logging import ServerLogHandler
-from .util import find_executables
+from .util import find_executables, write_if_changed, load_pickle, save_pickle
 from .commandtool import CommandToolWrapper
 from .server import (UnixSocketServer, NamedPipeServer)
 from .meson import Meson
+from .trace import Tracer
+
+# KEY:TYPE=VALUE lines of CMakeCache.txt
+CACHE_ENTRY_REGEX = re.compile(r'^(?:"([^"]*)"|([^:="]+))(?::([A-Za-z]+))?=(.*)$')
+# set(<var> <value>... CACHE <type> <docstring> [FORCE]) commands of -C scripts
+CACHE_SET_REGEX = re.compile(r'^\s*set\s*\(([^)]*)\)', re.IGNORECASE | re.MULTILINE)
+CACHE_SET_ARG_REGEX = re.compile(r'"((?:[^"\\]|\\.)*)"|([^\s"]+)')
+
+# Types of cache entries, see -D<var>:<type>=<value>
+CACHE_TYPES = ('BOOL', 'FILEPATH', 'PATH', 'STRING', 'INTERNAL', 'STATIC', 'UNINITIALIZED')
+# Cache entry properties persisted as <key>-<property>:INTERNAL entries
+CACHE_PROPERTIES = ('ADVANCED', 'MODIFIED', 'STRINGS')
+
+# Prefix of cache entries mapped to Meson build options
+MESON_OPTION_PREFIX = 'MESON_'
+# CMake --log-level values and the Python levels they map to
+LOG_LEVELS = {
+    'ERROR': logging.ERROR,
+    'WARNING': logging.WARNING,
+    'NOTICE': logging.INFO,
+    'STATUS': logging.INFO,
+    'INFO': logging.INFO,
+    'VERBOSE': logging.DEBUG,
+    'DEBUG': logging.DEBUG,
+    'TRACE': logging.DEBUG,
+}
+# meson-cmake-wrapper.log is rotated when it reaches this size
+LOG_MAX_BYTES = 1024 * 1024
+LOG_BACKUP_COUNT = 1
+
+# CMAKE_BUILD_TYPE to Meson buildtype, anything else maps to 'plain'
+BUILD_TYPES = {
+    '': 'debug',
+    'DEBUG': 'debug',
+    'RELEASE': 'release',
+    'RELWITHDEBINFO': 'debugoptimized',
+    'MINSIZEREL': 'minsize',
+}
 
 
 class CMakeWrapper:
@@ -22,16 +63,28 @@ class CMakeWrapper:
         self.version = [3, 10, 0]
         self.path = sys.argv[0]
         self.debug = False
+        self.log_levels = {}
         self.command = 'generate'
         self.generator = None
         self.build_type = None
+        self.build_config = None
+        self.configurations = []
+        self.config_mesons = {}
         self.cache_entries = {}
-        self.target = 'all'
+        self.initial_cache_entries = {}
+        self.meson_options = set()
+        self.targets = []
         self.target_args = []
+        self.jobs = None
+        self.clean_first = False
         self.build_dir = None
         self.source_dir = None
         self.gen_cmake = False
+        self.skip_subproject_files = False
+        self.profiling_output = None
+        self.tracer = Tracer()
         self.meson = Meson()
+        self.meson.tracer = self.tracer
         if os.name == 'nt':
             self.server = NamedPipeServer(self)
         else:
@@ -42,12 +95,24 @@ class CMakeWrapper:
     def run(self, args):
         self.init_logging()
 
-        self.log('(args) "%s"' % args)
-        self.log('(cwd) "%s"' % os.getcwd())
+        self.log('(args) "%s"', args)
+        self.log('(cwd) "%s"', os.getcwd())
 
         # debug_connect()
 
-        self.parse_args(args)
+        try:
+            # Use environment variable 'MCW_LOG_LEVEL' to set log levels, e.g. 'DEBUG' or 'Meson=DEBUG,Server=WARNING'
+            if os.environ.get('MCW_LOG_LEVEL'):
+                self.set_log_levels(os.environ['MCW_LOG_LEVEL'])
+            self.parse_args(args)
+        except RuntimeError as e:
+            print(e.args[0])
+            exit(1)
+        self.apply_log_levels()
+
+        # Use environment variable 'MCW_TRACE' to record a Chrome trace of mcw itself
+        if os.environ.get('MCW_TRACE'):
+            self.tracer.enabled = True
 
         # Unknown command
         if not hasattr(self, self.command + '_cmd'):
@@ -56,7 +121,8 @@ class CMakeWrapper:
 
         # Run command
         try:
-            getattr(self, self.command + '_cmd')()
+            with self.tracer.span(self.command, 'mcw'):
+                getattr(self, self.command + '_cmd')()
         except RuntimeError as e:
             print(e.args[0])
             self.log(e)
@@ -64,7 +130,8 @@ class CMakeWrapper:
         except Exception as e:
             self.log(e)
             raise e
-        self.save_cache_entries()
+        finally:
+            self.write_trace()
 
     def parse_args(self, args):
         if len(args) == 1:
@@ -77,6 +144,17 @@ class CMakeWrapper:
                 self.command = 'help'
             elif args[i] == '--debug-output':
                 self.debug = True
+            elif args[i].startswith('--log-level='):
+                self.set_log_levels(args[i].split('=', 1)[1])
+            elif args[i].startswith('--profiling-format='):
+                # Reported like other usage errors by run, without a traceback
+                if args[i].split('=', 1)[1] != 'google-trace':
+                    raise RuntimeError('CMake Error: Invalid format specified for --profiling-format: %s\n'
+                                       'Supported formats: google-trace\n'
+                                       'Run \'cmake --help\' for all supported options.' % args[i].split('=', 1)[1])
+                self.tracer.enabled = True
+            elif args[i].startswith('--profiling-output='):
+                self.profiling_output = os.path.abspath(args[i].split('=', 1)[1])
             elif args[i] in ('--warn-uninitialized', '--warn-unused-vars', '--no-warn-unused-cli'):
                 pass
             elif args[i] == '--help-module-list':
@@ -93,16 +171,35 @@ class CMakeWrapper:
             elif args[i].startswith('-G'):
                 self.command = 'generate'
                 self.set_generator(args[i][2:])
+            elif args[i] == '-C':
+                i += 1
+                self.load_initial_cache(args[i])
+            elif args[i].startswith('-C'):
+                self.load_initial_cache(args[i][2:])
             elif args[i] == '--build':
                 self.command = 'build'
                 i += 1
                 self.set_build_dir(args[i])
-            elif args[i] == '--target':
-                i += 1
-                self.target = args[i]
+            elif args[i] in ('--target', '-t'):
+                # Multiple targets may follow --target
+                while i + 1 < len(args) and not args[i + 1].startswith('-'):
+                    i += 1
+                    self.targets.append(args[i])
+            elif args[i] in ('-j', '--parallel'):
+                # The number of jobs is optional, 0 leaves it to the build tool
+                if i + 1 < len(args) and args[i + 1].isdigit():
+                    i += 1
+                    self.jobs = int(args[i])
+                else:
+                    self.jobs = 0
+            elif args[i].startswith('-j') and args[i][2:].isdigit():
+                self.jobs = int(args[i][2:])
+            elif args[i] == '--clean-first':
+                self.clean_first = True
             elif args[i] == '--config':
+                # Only selects the configuration to build, the active configuration stays as it is
                 i += 1
-                self.set_build_type(args[i])
+                self.build_config = args[i]
             elif args[i] == '--':
                 self.target_args = args[i + 1:]
                 break
@@ -141,8 +238,16 @@ class CMakeWrapper:
         print('  -G <generator-name>          = Specify a build system generator.')
         print('  -E                           = CMake command mode.\n')
         print('  --build <dir>                = Build a CMake-generated project binary tree.')
+        print('    --target <tgt>..., -t <tgt>... = Build <tgt> instead of default targets.')
+        print('    -j [<jobs>], --parallel [<jobs>] = Build in parallel using the given number of jobs.')
+        print('    --clean-first              = Build target \'clean\' first, then build.')
+        print('    -- <native args>           = Pass remaining options to the native tool.')
         print('  --version,-version,/V [<f>]  = Print version number and exit.')
-        print('  --debug-output               = Put cmake in a debug mode.\n')
+        print('  --debug-output               = Put cmake in a debug mode.')
+        print('  --log-level=<level>          = Set the log level to one of: ERROR, WARNING, NOTICE, STATUS,')
+        print('                                 VERBOSE, DEBUG or TRACE, optionally per logger, e.g. Meson=DEBUG')
+        print('  --profiling-format=<fmt>     = Output data for profiling mcw. Supported formats: google-trace')
+        print('  --profiling-output=<file>    = Select an output path for the profiling data.\n')
         print('Generators\n')
         print('The following generators are available on this platform:')
         print('  Unix Makefiles               = Generates standard UNIX makefiles.')
@@ -166,23 +271,29 @@ class CMakeWrapper:
 
         # Make sure meson is setup
         self.load_cache_entries()
-        self.meson.setup()
+        with self.tracer.span('setup', 'generate'):
+            self.setup_configurations()
 
         # Create CMakeCache.txt
-        self.gen_cmake_cache()
+        with self.tracer.span('gen_cmake_cache', 'generate'):
+            self.gen_cmake_cache()
         self.save_cache_entries()
 
         if self.gen_cmake:
-            self.gen_cmake_project()
+            with self.tracer.span('gen_cmake_project', 'generate'):
+                self.gen_cmake_project()
 
         if self.generator.endswith('Unix Makefiles'):
-            self.gen_make_project()
+            with self.tracer.span('gen_make_project', 'generate'):
+                self.gen_make_project()
 
         if self.generator.startswith('CodeBlocks'):
-            self.gen_codeblocks_project()
+            with self.tracer.span('gen_codeblocks_project', 'generate'):
+                self.gen_codeblocks_project()
 
         if self.generator.startswith('Android Gradle'):
-            self.gen_android_gradle_project()
+            with self.tracer.span('gen_android_gradle_project', 'generate'):
+                self.gen_android_gradle_project()
 
     def build_cmd(self):
         # Set default build dir
@@ -191,10 +302,17 @@ class CMakeWrapper:
 
         # Make sure meson is setup
         self.load_cache_entries()
-        self.meson.setup()
+        meson = self.get_config_meson(self.build_config or self.get_active_config())
+        meson.setup()
 
-        print('Building target: ' + self.target)
-        self.meson.build(self.target)
+        # Fall back to the job count CMake reads from the environment
+        jobs = self.jobs
+        if jobs is None and os.environ.get('CMAKE_BUILD_PARALLEL_LEVEL', '').isdigit():
+            jobs = int(os.environ['CMAKE_BUILD_PARALLEL_LEVEL'])
+
+        targets = self.targets or ['all']
+        print('Building targets: ' + ' '.join(targets))
+        meson.build(targets, jobs, self.clean_first, self.target_args)
 
     def tool_cmd(self):
         self.tool.run(self.command_args)
@@ -211,6 +329,8 @@ class CMakeWrapper:
 
         # Cleanup if reinitialized
         for logger in loggers:
+            for handler in logger.handlers:
+                handler.close()
             logger.handlers = []
 
         if not dir and self.debug:
@@ -219,35 +339,60 @@ class CMakeWrapper:
         # Setup handlers and formatters
         handlers = []
         if dir:
-            handler = logging.FileHandler(os.path.join(dir, 'meson-cmake-wrapper.log'))
-            handler.setLevel(logging.INFO)
+            handler = logging.handlers.RotatingFileHandler(os.path.join(dir, 'meson-cmake-wrapper.log'),
+                                                           maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT)
             formatter = logging.Formatter('%(asctime)s - %(name)s: %(message)s')
             handler.setFormatter(formatter)
             handlers.append(handler)
 
         if self.debug:
             handler = logging.StreamHandler(sys.stderr)
-            handler.setLevel(logging.INFO)
             formatter = logging.Formatter('%(name)s: %(message)s')
             handler.setFormatter(formatter)
             handlers.append(handler)
 
             handler = ServerLogHandler(self.server)
-            handler.setLevel(logging.INFO)
             formatter = logging.Formatter('%(name)s: %(message)s')
             handler.setFormatter(formatter)
             handlers.append(handler)
 
         for logger in loggers:
-            logger.setLevel(logging.INFO)
             for handler in handlers:
                 logger.addHandler(handler)
-
-    def log(self, msg):
+        self.apply_log_levels()
+
+    def set_log_levels(self, levels):
+        """
+        Parse a comma separated list of levels, each optionally prefixed with a logger name.
+        """
+        for level in levels.split(','):
+            name, _, level = level.strip().rpartition('=')
+            if level.upper() not in LOG_LEVELS:
+                raise RuntimeError('Unsupported log level: ' + level)
+            self.log_levels[name.strip()] = LOG_LEVELS[level.upper()]
+
+    def apply_log_levels(self):
+        # Loggers filter records before their arguments are formatted, so handlers accept every level
+        default = self.log_levels.get('', logging.DEBUG if self.debug else logging.INFO)
+        for logger in (self.logger, self.meson.logger, self.server.logger):
+            logger.setLevel(self.log_levels.get(logger.name, default))
+
+    def log(self, msg, *args, level=logging.INFO):
         if isinstance(msg, Exception):
-            self.logger.info(msg, exc_info=msg)
+            self.logger.error(msg, exc_info=msg)
         else:
-            self.logger.info(msg)
+            self.logger.log(level, msg, *args)
+
+    def write_trace(self):
+        if not self.tracer.enabled:
+            return
+
+        trace_file = self.profiling_output or os.path.join(self.build_dir or os.getcwd(), 'mcw-trace.json')
+        self.tracer.write(trace_file)
+
+        summary = self.tracer.get_summary()
+        self.log('(trace) "%s" %s', trace_file, ', '.join(
+            '%s: %.3fs (%d spans)' % (category, summary[category][1], summary[category][0]) for category in sorted(summary)))
 
     def set_generator(self, generator):
         if generator == 'Ninja':
@@ -264,7 +409,7 @@ class CMakeWrapper:
             raise Exception('Generator not supported: ' + generator)
         self.generator = generator
 
-        self.log('(generator) "%s"' % self.generator)
+        self.log('(generator) "%s"', self.generator)
 
     def set_source_dir(self, source_dir):
         if not os.path.exists(source_dir):
@@ -275,7 +420,7 @@ class CMakeWrapper:
         self.source_dir = os.path.abspath(source_dir)
         self.meson.source_dir = self.source_dir
 
-        self.log('(source_dir) "%s"' % self.source_dir)
+        self.log('(source_dir) "%s"', self.source_dir)
 
     def set_build_dir(self, build_dir):
         if not os.path.exists(build_dir):
@@ -296,24 +441,83 @@ class CMakeWrapper:
                 with open(meson_file, 'w') as file:
                     file.write('project(\'empty\')')
 
-        self.log('(build_dir) "%s"' % self.build_dir)
+        self.log('(build_dir) "%s"', self.build_dir)
 
     def set_build_type(self, build_type):
         self.build_type = build_type
-        if build_type.upper() in ('DEBUG', ''):
-            self.meson.build_type = 'debug'
-        elif build_type.upper() == 'RELEASE':
-            self.meson.build_type = 'release'
-        elif build_type.upper() == 'RELWITHDEBINFO':
-            self.meson.build_type = 'debugoptimized'
-        elif build_type.upper() == 'MINSIZEREL':
-            self.meson.build_type = 'minsize'
-        else:
-            self.meson.build_type = 'plain'
+        self.meson.build_type = BUILD_TYPES.get(build_type.upper(), 'plain')
 
         self.cache_entries['CMAKE_BUILD_TYPE'] = (build_type, 'STRING')
 
-        self.log('(build_type) "%s"' % self.build_type)
+        self.log('(build_type) "%s"', self.build_type)
+
+    def set_configurations(self, configurations):
+        self.configurations = [config for config in configurations.split(';') if config]
+        self.config_mesons = {}
+        # Without CMAKE_BUILD_TYPE the build dir itself holds the first configuration
+        if not self.build_type and self.configurations:
+            self.meson.build_type = BUILD_TYPES.get(self.configurations[0].upper(), 'plain')
+
+        self.log('(configurations) "%s"', self.configurations)
+
+    def get_config_meson(self, config):
+        """
+        Get the Meson instance of a configuration.
+        The active configuration uses the build dir itself,
+        other configurations use sibling Meson build dirs at <build-dir>-<config>,
+        outside the build dir so wiping it leaves them alone.
+        """
+        if not self.configurations or not config:
+            return self.meson
+        if config.upper() == self.get_active_config().upper():
+            return self.meson
+        if config.upper() not in [configuration.upper() for configuration in self.configurations]:
+            raise RuntimeError('Configuration "%s" is not one of CMAKE_CONFIGURATION_TYPES: %s'
+                               % (config, ';'.join(self.configurations)))
+
+        if config not in self.config_mesons:
+            config_dir = self.build_dir + '-' + config
+            pathlib.Path(config_dir).mkdir(exist_ok=True)
+            self.config_mesons[config] = self.meson.clone(config_dir, BUILD_TYPES.get(config.upper(), 'plain'))
+        return self.config_mesons[config]
+
+    def get_configurations(self):
+        """
+        Get (name, meson) pairs of all configurations.
+        """
+        if not self.configurations:
+            return [(self.build_type, self.meson)]
+        configurations = [(config, self.get_config_meson(config)) for config in self.configurations]
+        # The build dir itself is always a configuration, even if CMAKE_BUILD_TYPE is not a configuration type
+        if all(meson is not self.meson for _, meson in configurations):
+            configurations.insert(0, (self.get_active_config(), self.meson))
+        return configurations
+
+    def get_active_config(self):
+        """
+        Get the configuration of the build dir itself, CMAKE_BUILD_TYPE or else the first configuration type.
+        """
+        if self.build_type or not self.configurations:
+            return self.build_type
+        return self.configurations[0]
+
+    def setup_configurations(self):
+        """
+        Setup and introspect the build dirs of all configurations concurrently.
+        """
+        configurations = self.get_configurations()
+        if len(configurations) == 1:
+            self.meson.setup()
+            return
+
+        def setup(meson):
+            meson.setup(show=False)
+            meson.get_targets()
+            meson.get_project_info()
+
+        with ThreadPoolExecutor(max_workers=len(configurations)) as executor:
+            for future in [executor.submit(setup, meson) for _, meson in configurations]:
+                future.result()
 
     def get_entry(self, entry):
         if entry in self.cache_entries:
@@ -353,13 +557,15 @@ class CMakeWrapper:
         self.cache_entries = cache_entries
 
     def parse_cache_entry(self, entry):
-        if ':' in entry:
-            key, rest = entry[2:].split(':', 1)
-            ty, val = rest.split('=', 1)
+        key, val = entry[2:].split('=', 1)
+        # Subproject options are named <subproject>:<option>, so only a known type is split off
+        name, sep, ty = key.rpartition(':')
+        if sep and ty.upper() in CACHE_TYPES:
+            key, ty = name, ty.upper()
         else:
-            key, val = entry[2:].split('=', 1)
             ty = 'STRING'
-        self.cache_entries[key] = (val, ty, '')
+        if not key.startswith(MESON_OPTION_PREFIX):
+            self.cache_entries[key] = (val, ty, '')
         self.update_cache_entry(key, val)
 
     def update_cache_entry(self, key, val):
@@ -367,6 +573,9 @@ class CMakeWrapper:
             self.set_generator(val)
         elif key == 'CMAKE_BUILD_TYPE':
             self.set_build_type(val)
+        # Use CMake variable 'CMAKE_CONFIGURATION_TYPES' for multi-configuration build dirs
+        elif key == 'CMAKE_CONFIGURATION_TYPES':
+            self.set_configurations(val)
         elif key == 'CMAKE_HOME_DIRECTORY':
             self.set_source_dir(val)
         elif key == 'CMAKE_C_COMPILER':
@@ -375,8 +584,10 @@ class CMakeWrapper:
             os.environ['CXX'] = val
         elif key == 'CMAKE_C_FLAGS':
             os.environ['CFLAGS'] = val
+            self.meson.set_option('c_args', shlex.split(val))
         elif key == 'CMAKE_CXX_FLAGS':
             os.environ['CXXFLAGS'] = val
+            self.meson.set_option('cpp_args', shlex.split(val))
         # Use CMake variable 'MCW_MESON' for custom Meson path
         elif key == 'MCW_MESON':
             self.meson.path = val
@@ -386,34 +597,165 @@ class CMakeWrapper:
         # Use CMake variable 'MCW_GEN_CMAKE' to toggle cmake project generation
         elif key == 'MCW_GEN_CMAKE':
             self.gen_cmake = True
+        # Use CMake variable 'MCW_SKIP_SUBPROJECT_FILES' to leave the files of subprojects out of the codemodel
+        elif key == 'MCW_SKIP_SUBPROJECT_FILES':
+            self.skip_subproject_files = val.upper() in ('1', 'ON', 'YES', 'TRUE', 'Y')
+        # Use CMake variables 'MESON_<option>' for setting Meson build options, they are applied once
+        elif key.startswith(MESON_OPTION_PREFIX):
+            self.meson_options.add(key[len(MESON_OPTION_PREFIX):])
+            for meson in [self.meson] + list(self.config_mesons.values()):
+                meson.set_option(key[len(MESON_OPTION_PREFIX):], val)
+
+    def get_meson_cache_entries(self):
+        """
+        Get the Meson build options as (value, type, properties) cache entries.
+        """
+        if not self.meson.backend or not self.meson.backend.setup():
+            return {}
+
+        cache_entries = {}
+        for option in self.meson.get_build_options():
+            value = option['value']
+            properties = {'HELPSTRING': option.get('description', '')}
+            if option['type'] == 'boolean':
+                ty = 'BOOL'
+                value = 'ON' if value else 'OFF'
+            elif option['type'] == 'array':
+                ty = 'STRING'
+                value = ';'.join(value)
+            elif option['section'] == 'directory':
+                ty = 'PATH'
+            else:
+                ty = 'STRING'
+            if option.get('choices'):
+                properties['STRINGS'] = ';'.join(map(str, option['choices']))
+            # Only project options are shown by default
+            if option['section'] != 'user':
+                properties['ADVANCED'] = '1'
+            cache_entries[MESON_OPTION_PREFIX + option['name']] = (str(value), ty, properties)
+        return cache_entries
+
+    def parse_cache_file(self, cache_file):
+        """
+        Parse the entries of an existing CMakeCache.txt.
+        """
+        entries = {}
+        with open(cache_file) as file:
+            for line in file:
+                line = line.strip()
+                if not line or line.startswith(('#', '//')):
+                    continue
+                match = CACHE_ENTRY_REGEX.match(line)
+                if match:
+                    key = match.group(1) if match.group(1) is not None else match.group(2)
+                    if key.rsplit('-', 1)[-1] in CACHE_PROPERTIES:
+                        continue
+                    entries[key] = (match.group(4), match.group(3) or 'STRING')
+        return entries
+
+    def parse_cache_script(self, script_file):
+        """
+        Parse the cache entries set by a -C initial cache script.
+        """
+        entries = {}
+        with open(script_file) as file:
+            script = '\n'.join(line for line in file.read().split('\n') if not line.lstrip().startswith('#'))
+        for match in CACHE_SET_REGEX.finditer(script):
+            args = [quoted if quoted else bare for quoted, bare in CACHE_SET_ARG_REGEX.findall(match.group(1))]
+            if 'CACHE' not in args[1:]:
+                continue
+            cache_index = args.index('CACHE', 1)
+            ty = args[cache_index + 1] if len(args) > cache_index + 1 else 'STRING'
+            entries[args[0]] = (';'.join(args[1:cache_index]), ty)
+        return entries
+
+    def load_initial_cache(self, script_file):
+        if not os.path.isfile(script_file):
+            raise RuntimeError('Error processing file: ' + script_file)
+        self.initial_cache_entries.update(self.parse_cache_script(script_file))
+
+        self.log('(initial_cache) "%s"', script_file)
+
+    def merge_cache_entries(self, entries):
+        for key in set(entries) - set(self.cache_entries):
+            if not key.startswith(MESON_OPTION_PREFIX):
+                self.cache_entries[key] = entries[key]
+            self.update_cache_entry(key, entries[key][0])
+
+    def clear_meson_options(self):
+        """
+        Forget the applied 'MESON_<option>' entries, so they do not undo later 'meson configure' changes.
+        """
+        for meson in [self.meson] + list(self.config_mesons.values()):
+            for name in self.meson_options:
+                meson.options.pop(name, None)
+        self.meson_options = set()
 
     def save_cache_entries(self):
+        """
+        Save the cache entries, only called by commands that loaded them first.
+        """
         if self.build_dir:
-            cache_file = os.path.join(self.build_dir, 'cmake-cache.pk1')
-            with open(cache_file, 'wb') as output:
-                pickle.dump(self.cache_entries, output, pickle.HIGHEST_PROTOCOL)
+            save_pickle(os.path.join(self.build_dir, 'cmake-cache.pk1'), self.cache_entries)
 
     def load_cache_entries(self):
         cache_file = os.path.join(self.build_dir, 'cmake-cache.pk1')
-        if os.path.exists(cache_file):
-            with open(cache_file, 'rb') as input:
-                loaded_entries = pickle.load(input)
-                diff_entries = set(loaded_entries) - set(self.cache_entries)
-
-                for key in diff_entries:
-                    self.cache_entries[key] = loaded_entries[key]
-                    self.update_cache_entry(key, loaded_entries[key][0])
+        cmake_cache_file = os.path.join(self.build_dir, 'CMakeCache.txt')
+        # An empty cache was written by earlier versions that saved it without loading it
+        loaded_entries = load_pickle(cache_file) or None
+        if loaded_entries is None and os.path.exists(cmake_cache_file):
+            # Seed from a CMakeCache.txt left by another IDE or CI runner, unless it was copied from another build dir
+            loaded_entries = self.parse_cache_file(cmake_cache_file)
+            cache_dir = loaded_entries.get('CMAKE_CACHEFILE_DIR', (self.build_dir,))[0]
+            if os.path.abspath(cache_dir) != self.build_dir:
+                loaded_entries = None
+
+        if loaded_entries is not None:
+            # Meson build options are read back from the build dir itself, never reapplied from the cache
+            loaded_entries = {key: val for key, val in loaded_entries.items()
+                              if not key.startswith(MESON_OPTION_PREFIX)}
+
+        if loaded_entries:
+            self.merge_cache_entries(loaded_entries)
+            self.merge_cache_entries(self.initial_cache_entries)
         elif self.build_dir:
+            self.merge_cache_entries(self.initial_cache_entries)
             self.init_cache_entries()
 
     def gen_cmake_cache(self):
-        with open(os.path.join(self.build_dir, 'CMakeCache.txt'), 'w') as file:
-            file.write('# Generated by meson-cmake-wrapper\n\n')
-            file.write('########################\n')
-            file.write('# Cache entries\n')
-            file.write('########################\n\n')
-            for entry in self.cache_entries.items():
-                file.write('%s:%s=%s\n' % (entry[0], entry[1][1], entry[1][0]))
+        meson_entries = self.get_meson_cache_entries()
+
+        content = '# Generated by meson-cmake-wrapper\n\n'
+        content += '########################\n'
+        content += '# Cache entries\n'
+        content += '########################\n\n'
+        for key, val in sorted(self.cache_entries.items()):
+            if key not in meson_entries:
+                content += '%s:%s=%s\n' % (key, val[1], val[0])
+
+        content += '\n########################\n'
+        content += '# Meson build options\n'
+        content += '########################\n\n'
+        for key, val in sorted(meson_entries.items()):
+            content += '//%s\n' % val[2]['HELPSTRING']
+            content += '%s:%s=%s\n\n' % (self.quote_cache_key(key), val[1], val[0])
+
+        content += '########################\n'
+        content += '# INTERNAL cache entries\n'
+        content += '########################\n\n'
+        for key, val in sorted(meson_entries.items()):
+            for prop in CACHE_PROPERTIES:
+                if prop in val[2]:
+                    content += '%s:INTERNAL=%s\n' % (self.quote_cache_key(key + '-' + prop), val[2][prop])
+
+        # Only touch CMakeCache.txt on change to avoid triggering IDE file watchers
+        write_if_changed(os.path.join(self.build_dir, 'CMakeCache.txt'), content)
+
+    def quote_cache_key(self, key):
+        # Subproject options are named <subproject>:<option>
+        if ':' in key or '=' in key:
+            return '"%s"' % key
+        return key
 
     def gen_cmake_project(self):
         with open(os.path.join(self.source_dir, 'CMakeLists.txt'), 'w') as file:
@@ -461,8 +803,13 @@ class CMakeWrapper:
             'filename': ''
         }
 
+        # Target names are only unique per directory, so targets sharing a name are titled by their id
+        names = [target['name'] for target in self.meson.get_targets()]
+        titles = {target['id']: target['name'] if names.count(target['name']) == 1 else target['id']
+                  for target in [all_target] + self.meson.get_targets()}
+
         for target in [all_target] + self.meson.get_targets():
-            build_target = ETree.SubElement(build, 'Target', {'title': target['name']})
+            build_target = ETree.SubElement(build, 'Target', {'title': titles[target['id']]})
             output = os.path.join(self.meson.build_dir, self.meson.get_target_filename(target))
             output_dir = os.path.split(output)[0]
             ETree.SubElement(build_target, 'Option', {'output': output})
@@ -488,25 +835,30 @@ class CMakeWrapper:
                 ETree.SubElement(compiler, 'Add', {'directory': include_dir})
 
             make_commands = ETree.SubElement(build_target, 'MakeCommands')
-            ETree.SubElement(make_commands, 'Build', {'command': self.meson.backend.path + ' -v ' + self.meson.backend.get_target(target['name'])})
-            ETree.SubElement(make_commands, 'CompileFile', {'command': self.meson.backend.path + ' -v ' + self.meson.backend.get_target(target['name'])})
+            ninja_targets = ' '.join(self.meson.backend.get_target(target['id']))
+            ETree.SubElement(make_commands, 'Build', {'command': self.meson.backend.path + ' -v ' + ninja_targets})
+            # Compile only the object of the file, not the whole target
+            ETree.SubElement(make_commands, 'CompileFile', {'command': '%s -E compile_file "$file" "%s"' % (self.path, self.build_dir)})
             ETree.SubElement(make_commands, 'Clean', {'command': self.meson.backend.path + ' -v clean'})
             ETree.SubElement(make_commands, 'DistClean', {'command': self.meson.backend.path + ' -v clean'})
 
+        # Files shared by several targets are one unit with an option per target
+        units = []
+        unit_targets = {}
         for target in self.meson.get_targets():
-            target_files = self.meson.get_target_files(target)
-            for target_file in target_files:
-                unit = ETree.SubElement(project, 'Unit', {'filename': os.path.join(self.source_dir, target_file)})
-                ETree.SubElement(unit, 'Option', {'target': target['name']})
-
-                base = os.path.splitext(os.path.basename(target_file))[0]
-                header_exts = ('h', 'hpp')
-                for ext in header_exts:
-                    header_file = os.path.abspath(
-                        os.path.join(self.source_dir, os.path.dirname(target_file), os.path.join(base + '.' + ext)))
-                    if os.path.exists(header_file):
-                        unit = ETree.SubElement(project, 'Unit', {'filename': header_file})
-                        ETree.SubElement(unit, 'Option', {'target': target['name']})
+            files = [os.path.join(self.source_dir, target_file) for target_file in self.meson.get_target_files(target)]
+            files += self.get_target_headers(target)
+            for file in files:
+                if file not in unit_targets:
+                    units.append(file)
+                    unit_targets[file] = []
+                if titles[target['id']] not in unit_targets[file]:
+                    unit_targets[file].append(titles[target['id']])
+
+        for file in units:
+            unit = ETree.SubElement(project, 'Unit', {'filename': file})
+            for title in unit_targets[file]:
+                ETree.SubElement(unit, 'Option', {'target': title})
 
         for file in self.meson.get_buildsystem_files():
             unit = ETree.SubElement(project, 'Unit', {'filename': os.path.join(self.source_dir, file)})
@@ -597,7 +949,7 @@ class CMakeWrapper:
                         depend_file.write('    )\n')
                         depend_file.write('set(CMAKE_DEPENDS_CHECK_%s\n' % lang)
                         for target_file in self.meson.get_target_files(target):
-                            object_path = os.path.join(self.build_dir, os.path.dirname(self.meson.get_target_filename(target)), target['id'], os.path.basename(target_file) + '.o')
+                            object_path = os.path.join(self.build_dir, self.get_object_path(target, target_file))
                             depend_file.write('  "%s" "%s"\n' % (os.path.join(self.source_dir, target_file), object_path))
                         depend_file.write('  )\n')
                         depend_file.write('set(CMAKE_TARGET_DEFINITIONS_%s\n' % lang)
@@ -609,16 +961,31 @@ class CMakeWrapper:
                             depend_file.write('  "%s"\n' % os.path.relpath(inc_dir, self.build_dir))
                         depend_file.write('  )')
 
+                # Objects depend on the files Ninja recorded the last time they were built
+                deps = self.meson.backend.get_deps()
+                with open(os.path.join(target_path, 'depend.make'), 'w') as depend_make_file:
+                    depend_make_file.write('# Dependencies of target %s\n' % target['name'])
+                    for target_file in self.meson.get_target_files(target):
+                        object_path = self.get_object_path(target, target_file)
+                        for dep in deps.get(object_path, []):
+                            depend_make_file.write('%s: %s\n' % (object_path, dep))
+
                 # CLion requires TARGET_PATH/link.txt
                 with open(os.path.join(target_path, 'link.txt'), 'w') as link_file:
                     link_file.write('%s qc %s ' % (self.get_entry('CMAKE_AR'), os.path.basename(self.meson.get_target_filename(target))))
                     for target_file in self.meson.get_target_files(target):
-                        link_file.write('%s ' % os.path.join(os.path.dirname(self.meson.get_target_filename(target)), target['id'], os.path.basename(target_file) + '.o'))
+                        link_file.write('%s ' % self.get_object_path(target, target_file))
                     link_file.write('\n%s %s' % (self.get_entry('CMAKE_RANLIB'), os.path.basename(self.meson.get_target_filename(target))))
 
                 # CLion fetches target name from TARGET_PATH/build.make
                 with open(os.path.join(target_path, 'build.make'), 'w') as build_file:
-                    build_file.write('%s: %s' % (os.path.join(target_path, 'build'), self.meson.get_output(target)))
+                    build_file.write('%s: %s\n' % (os.path.join(target_path, 'build'), self.meson.get_output(target)))
+                    # Per source rules let the IDE compile a single file
+                    for target_file in self.meson.get_target_files(target):
+                        source = os.path.join(self.source_dir, target_file)
+                        build_file.write('\n%s: %s\n' % (self.get_object_path(target, target_file), source))
+                        build_file.write('\t%s -E compile_file %s %s\n' % (self.path, shlex.quote(source),
+                                                                           shlex.quote(self.build_dir)))
 
                 with open(os.path.join(target_path, 'flags.make'), 'w') as flags_file:
                     if lang:
@@ -626,6 +993,34 @@ class CMakeWrapper:
                         flags_file.write('%s_DEFINES = %s\n' % (lang, ' '.join(self.meson.get_defines(target))))
                         flags_file.write('%s_INCLUDES = %s\n' % (lang, ' '.join(['-I' + inc_dir for inc_dir in self.meson.get_include_directories(target, False)])))
 
+    def get_target_headers(self, target):
+        """
+        Get the headers of a target from the dependencies Ninja recorded.
+        Before the target is built, headers named like its sources are guessed instead.
+        """
+        headers = self.meson.get_target_headers(target)
+        if headers:
+            return headers
+
+        headers = []
+        for target_file in self.meson.get_target_files(target):
+            base = os.path.splitext(os.path.join(self.source_dir, target_file))[0]
+            for ext in ('h', 'hpp'):
+                header_file = os.path.abspath(base + '.' + ext)
+                if os.path.exists(header_file):
+                    headers.append(header_file)
+        return headers
+
+    def get_object_path(self, target, target_file):
+        """
+        Get the object file of a target source relative to the build dir.
+        """
+        object_path = self.meson.get_object_output(target, target_file)
+        if object_path:
+            return object_path
+        return os.path.join(os.path.dirname(self.meson.get_target_filename(target)), target['id'],
+                            os.path.basename(target_file) + '.o')
+
     def gen_android_gradle_project(self):
         if not self.get_entry('ANDROID_ABI'):
             raise RuntimeError('ANDROID_ABI must be set in Gradle projects')
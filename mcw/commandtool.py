@@ -1,6 +1,64 @@
 import os
+import sys
 import json
-import hashlib
+import time
+import shlex
+import queue
+import bisect
+import shutil
+import tarfile
+import zipfile
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+from .util import (CHUNK_SIZE, IO_WORKERS, file_digest, files_equal, text_files_equal, copy_file,
+                   copy_file_if_different, copy_tree, remove_tree)
+
+# Extensions of build outputs compiled from a single translation unit
+OBJECT_EXTS = ('.o', '.obj')
+# A target regressed if it got this much slower than the baseline
+REGRESSION_RATIO = 0.1
+REGRESSION_MIN_MS = 100
+# Number of chunks that are read ahead of the archive compressor
+PREFETCH_CHUNKS = 16
+TAR_COMPRESSIONS = {'z': 'gz', 'j': 'bz2', 'J': 'xz'}
+TAR_FORMATS = {'gnutar': tarfile.GNU_FORMAT, 'pax': tarfile.PAX_FORMAT, 'paxr': tarfile.PAX_FORMAT}
+
+# Markers in the prefetch queue
+MEMBER_END = object()
+ARCHIVE_END = object()
+
+
+class PrefetchReader:
+    """
+    Class that reads the data of one archive member from the prefetch queue.
+    """
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.buffer = bytearray()
+        self.done = False
+
+    def read(self, size=-1):
+        while not self.done and (size < 0 or len(self.buffer) < size):
+            chunk = self.chunks.get()
+            if chunk is MEMBER_END:
+                self.done = True
+            elif isinstance(chunk, Exception):
+                raise chunk
+            else:
+                self.buffer += chunk
+        if size < 0:
+            size = len(self.buffer)
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+    def drain(self):
+        while not self.done:
+            self.read(CHUNK_SIZE)
+
 
 class CommandToolWrapper:
     """
@@ -9,16 +67,25 @@ class CommandToolWrapper:
 
     def __init__(self, cmake):
         self.cmake = cmake
+        self.batch = False
 
     def list_cmds(self):
         print('CMake Error: cmake version ' + '.'.join(map(str, self.cmake.version)))
         print('Usage: meson-cmake-wrapper -E <command> [arguments...]')
         print('Available commands:')
+        print('  batch [<file>|-]          - run the commands in file or stdin, one per line, in one process')
+        print('  build_report [--json] [--top <n>] [--baseline <file>] [--save-baseline <file>] [build-dir]')
+        print('                            - report build times of targets and translation units from .ninja_log')
         print('  capabilities              - Report capabilities built into cmake in JSON format')
         print('  chdir dir cmd [args...]   - run command in a given directory')
-        print('  compare_files file1 file2 - check if file1 is same as file2')
+        print('  compare_files [--ignore-eol] file1 file2')
+        print('                            - check if file1 is same as file2')
+        print('  compile_file <file> [build-dir]')
+        print('                            - compile a single source file of the project in build-dir')
         print('  copy <file>... destination  - copy files to destination (either file or directory)')
         print('  copy_directory <dir>... destination   - copy content of <dir>... directories to \'destination\' directory')
+        print('  copy_directory_if_different <dir>... destination   - copy changed content of <dir>... directories to '
+              '\'destination\' directory')
         print('  copy_if_different <file>... destination  - copy files if it has changed')
         print('  echo [<string>...]        - displays arguments as text')
         print('  echo_append [<string>...] - displays arguments as text but no new line')
@@ -33,7 +100,7 @@ class CommandToolWrapper:
         print('  sha384sum <file>...       - create SHA384 checksum of files')
         print('  sha512sum <file>...       - create SHA512 checksum of files')
         print('  remove [-f] <file>...     - remove the file(s), use -f to force it')
-        print('  remove_directory dir      - remove a directory and its contents')
+        print('  remove_directory <dir>... - remove directories and their contents')
         print('  rename oldname newname    - rename a file or directory (on one volume)')
         print('  server                    - start cmake in server mode')
         print('  sleep <number>...         - sleep for given number of seconds')
@@ -51,6 +118,170 @@ class CommandToolWrapper:
             exit(1)
         getattr(self, args[0] + '_cmd')(args[1:])
 
+    def batch_cmd(self, args):
+        """
+        Run tool commands in this process, stopping at the first that fails.
+        Lines are split like a shell command line, blank lines and comments are skipped.
+        """
+        if not args or args[0] == '-':
+            lines = sys.stdin.readlines()
+        else:
+            with open(args[0]) as file:
+                lines = file.readlines()
+
+        self.batch = True
+        cwd = os.getcwd()
+        for line in lines:
+            command = shlex.split(line, comments=True)
+            if command and command[0] == '-E':
+                command = command[1:]
+            if not command:
+                continue
+            try:
+                self.run(command)
+            except SystemExit as e:
+                if e.code:
+                    sys.stdout.flush()
+                    raise
+            finally:
+                os.chdir(cwd)
+
+    def build_report_cmd(self, args):
+        build_dir = os.getcwd()
+        json_output = False
+        top = 10
+        baseline_file = None
+        save_file = None
+        i = 0
+        while i < len(args):
+            if args[i] == '--json':
+                json_output = True
+            elif args[i] == '--top':
+                i += 1
+                top = int(args[i])
+            elif args[i] == '--baseline':
+                i += 1
+                baseline_file = args[i]
+            elif args[i] == '--save-baseline':
+                i += 1
+                save_file = args[i]
+            else:
+                build_dir = args[i]
+            i += 1
+
+        self.cmake.set_build_dir(build_dir)
+        meson = self.cmake.meson
+        meson.set_backend('ninja')
+        entries = meson.backend.get_log_entries()
+        if not entries:
+            print('No .ninja_log in build directory: ' + self.cmake.build_dir)
+            exit(1)
+
+        report = self.get_build_report(entries, top)
+        if baseline_file:
+            with open(baseline_file) as file:
+                report['regressions'] = self.get_build_regressions(report, json.load(file))
+        if save_file:
+            with open(save_file, 'w') as file:
+                json.dump(report, file, indent=2)
+
+        if json_output:
+            print(json.dumps(report, indent=2))
+        else:
+            self.print_build_report(report)
+
+    def get_build_report(self, entries, top):
+        meson = self.cmake.meson
+        targets = {}
+        units = []
+        for output, (start, end, _, _) in entries.items():
+            output_target = meson.get_output_target(output)
+            name = output_target['name'] if output_target else '(other)'
+            target = targets.setdefault(name, {'name': name, 'duration': 0, 'steps': 0})
+            target['duration'] += end - start
+            target['steps'] += 1
+            if output.endswith(OBJECT_EXTS):
+                units.append({'output': output, 'target': name, 'duration': end - start})
+
+        return {
+            'buildDir': meson.build_dir,
+            'duration': sum(target['duration'] for target in targets.values()),
+            'targets': sorted(targets.values(), key=lambda target: target['duration'], reverse=True),
+            'units': sorted(units, key=lambda unit: unit['duration'], reverse=True)[:top],
+            'criticalPath': self.get_critical_path(entries),
+        }
+
+    def get_critical_path(self, entries):
+        """
+        Approximate the critical path of the last build from the log alone:
+        starting at the last step to finish, repeatedly follow the latest step
+        that finished before the current one started.
+        """
+        last_build = max(entry[3] for entry in entries.values())
+        steps = sorted((end, start, output) for output, (start, end, _, build) in entries.items() if build == last_build)
+        ends = [step[0] for step in steps]
+
+        path = []
+        index = len(steps) - 1
+        while index >= 0:
+            end, start, output = steps[index]
+            target = self.cmake.meson.get_output_target(output)
+            path.append({
+                'output': output,
+                'target': target['name'] if target else '(other)',
+                'start': start,
+                'duration': end - start
+            })
+            index = bisect.bisect_right(ends, start, 0, index) - 1
+        return list(reversed(path))
+
+    def get_build_regressions(self, report, baseline):
+        baseline_targets = {target['name']: target['duration'] for target in baseline['targets']}
+        baseline_units = {unit['output']: unit['duration'] for unit in baseline['units']}
+
+        comparisons = [
+            ('target', report['targets'], 'name', baseline_targets),
+            ('unit', report['units'], 'output', baseline_units),
+        ]
+
+        regressions = []
+        for kind, items, key, baseline_items in comparisons:
+            for item in items:
+                if item[key] not in baseline_items:
+                    continue
+                before = baseline_items[item[key]]
+                if item['duration'] - before >= max(REGRESSION_MIN_MS, before * REGRESSION_RATIO):
+                    regressions.append({
+                        'kind': kind,
+                        'name': item[key],
+                        'baseline': before,
+                        'duration': item['duration']
+                    })
+        return regressions
+
+    def print_build_report(self, report):
+        print('Build time by target (%.3fs total):' % (report['duration'] / 1000))
+        print('  %10s %6s  %s' % ('time', 'steps', 'target'))
+        for target in report['targets']:
+            print('  %9.3fs %6d  %s' % (target['duration'] / 1000, target['steps'], target['name']))
+
+        print('\nSlowest translation units:')
+        for unit in report['units']:
+            print('  %9.3fs  %s (%s)' % (unit['duration'] / 1000, unit['output'], unit['target']))
+
+        critical_path = report['criticalPath']
+        if critical_path:
+            duration = critical_path[-1]['start'] + critical_path[-1]['duration'] - critical_path[0]['start']
+            print('\nCritical path of last build (%.3fs):' % (duration / 1000))
+            for step in critical_path:
+                print('  %9.3fs  %s (%s)' % (step['duration'] / 1000, step['output'], step['target']))
+
+        if 'regressions' in report:
+            print('\nRegressions against baseline:')
+            for regression in report['regressions']:
+                print('  %9.3fs -> %.3fs  %s %s' % (regression['baseline'] / 1000, regression['duration'] / 1000,
+                                                    regression['kind'], regression['name']))
+
     def capabilities_cmd(self, args):
         data = {
             'generators': [
@@ -80,33 +311,111 @@ class CommandToolWrapper:
         print(json.dumps(data))
 
     def chdir_cmd(self, args):
-        os.chdir(args[0])
-        call(args[1:])
+        if len(args) < 2:
+            print('Error: chdir requires a directory and a command')
+            exit(1)
+        self.exec_command(args[1:], cwd=args[0])
 
     def compare_files_cmd(self, args):
-        if filecmp.cmp(args[0], args[1]):
+        compare = files_equal
+        if args and args[0] == '--ignore-eol':
+            compare = text_files_equal
+            args = args[1:]
+        if len(args) != 2:
+            print('Error: compare_files requires two files')
+            exit(2)
+        try:
+            equal = compare(args[0], args[1])
+        except OSError as e:
+            print('Error: %s' % e)
+            exit(2)
+        if equal:
             exit(0)
         print('Files "%s" to "%s" are different.' % (args[0], args[1]))
         exit(1)
 
+    def compile_file_cmd(self, args):
+        """
+        Compile a single source file, building only its object files instead of whole targets.
+        """
+        if not args:
+            print('Error: compile_file requires a source file')
+            exit(1)
+        source = os.path.abspath(args[0])
+        self.cmake.set_build_dir(args[1] if len(args) > 1 else os.getcwd())
+        meson = self.cmake.meson
+        meson.set_backend('ninja')
+
+        entries = meson.get_compile_commands_index().get(source)
+        if not entries:
+            print('Error: No compile command for "%s" in build directory: %s' % (source, self.cmake.build_dir))
+            exit(1)
+
+        # Let Ninja build the objects, so generated headers and other order-only dependencies are built first
+        outputs = [meson.get_compile_output(entry) for entry in entries]
+        target_index = meson.backend.get_target_index()
+        if all(output in target_index for output in outputs):
+            meson.backend.build(outputs, args=['-v'])
+            return
+
+        for entry in entries:
+            command = meson.get_compile_args(entry)
+            print(' '.join(shlex.quote(arg) for arg in command))
+            sys.stdout.flush()
+            code = subprocess.call(command, cwd=entry['directory'])
+            if code:
+                exit(code)
+
     def copy_cmd(self, args):
-        files = args[:-1]
-        dir = args[-1]
-        if not os.path.exists(dir):
-            os.makedirs(dir)
-        for file in files:
-            copy(file, dir)
+        self.copy_files(args, 'copy', copy_file, 'Error copying file "%s" to "%s".')
 
     def copy_if_different_cmd(self, args):
-        raise NotImplementedError()
+        self.copy_files(args, 'copy_if_different', copy_file_if_different,
+                        'Error copying file (if different) from "%s" to "%s".')
+
+    def copy_files(self, args, command, copy, error):
+        files = args[:-1]
+        destination = args[-1]
+        is_dir = os.path.isdir(destination)
+        if len(files) > 1 and not is_dir:
+            print('Error: Target (for %s command) "%s" is not a directory.' % (command, destination))
+            exit(1)
+
+        failed = False
+        with ThreadPoolExecutor(max_workers=IO_WORKERS) as executor:
+            futures = []
+            for file in files:
+                target = os.path.join(destination, os.path.basename(file)) if is_dir else destination
+                futures.append(executor.submit(copy, file, target))
+            for file, future in zip(files, futures):
+                try:
+                    future.result()
+                except OSError:
+                    print(error % (file, destination))
+                    failed = True
+        if failed:
+            exit(1)
 
     def copy_directory_cmd(self, args):
-        cp_dirs = args[:-1]
-        dir = args[-1]
-        if not os.path.exists(dir):
-            os.makedirs(dir)
-        for cp_dir in cp_dirs:
-            copytree(cp_dir, dir)
+        self.copy_directories(args, False)
+
+    def copy_directory_if_different_cmd(self, args):
+        self.copy_directories(args, True)
+
+    def copy_directories(self, args, if_different):
+        dirs = args[:-1]
+        destination = args[-1]
+        failed = False
+        with ThreadPoolExecutor(max_workers=IO_WORKERS) as executor:
+            for dir in dirs:
+                try:
+                    for future in copy_tree(dir, destination, executor, if_different):
+                        future.result()
+                except OSError:
+                    print('Error copying directory from "%s" to "%s".' % (dir, destination))
+                    failed = True
+        if failed:
+            exit(1)
 
     def echo_cmd(self, args):
         print(' '.join(args))
@@ -116,17 +425,43 @@ class CommandToolWrapper:
 
     def env_cmd(self, args):
         env = dict(os.environ)
-        for i in range(len(args)):
-            if '=' in args[i]:
-                if args[i].startswith('--unset'):
-                    env.pop(args[i].splits('=')[1], None)
-                else:
-                    key, val = args[i].split('=')
-                    env[key] = val
+        i = 0
+        while i < len(args):
+            if args[i].startswith('--unset='):
+                env.pop(args[i].split('=', 1)[1], None)
+            elif args[i] == '--':
+                i += 1
+                break
+            elif '=' in args[i][1:]:
+                key, val = args[i].split('=', 1)
+                env[key] = val
             else:
-                cmd = args[i:]
                 break
-        Popen(cmd, env=env)
+            i += 1
+        if i >= len(args):
+            print('Error: env requires a command')
+            exit(1)
+        self.exec_command(args[i:], env=env, cwd=None)
+
+    def exec_command(self, command, env=None, cwd=None):
+        """
+        Replace this process with command, so no Python process stays alive while it runs.
+        In batch mode the following commands still have to run, so command runs as a child instead.
+        """
+        sys.stdout.flush()
+        sys.stderr.flush()
+        try:
+            if self.batch:
+                code = subprocess.call(command, env=env, cwd=cwd)
+                if code:
+                    exit(code if code > 0 else 128 - code)
+                return
+            if cwd:
+                os.chdir(cwd)
+            os.execvpe(command[0], command, os.environ if env is None else env)
+        except OSError as e:
+            print('Error running "%s": %s' % (' '.join(command), e))
+            exit(1)
 
     def environment_cmd(self, args):
         for key, val in os.environ.items():
@@ -134,38 +469,41 @@ class CommandToolWrapper:
 
     def make_directory_cmd(self, args):
         for dir in args:
-            os.makedirs(dir)
+            os.makedirs(dir, exist_ok=True)
+
+    def checksum(self, algorithm, files):
+        """
+        Print checksums in the format of coreutils, hashing the files in parallel.
+        """
+        failed = False
+        with ThreadPoolExecutor(max_workers=IO_WORKERS) as executor:
+            futures = [executor.submit(file_digest, file, algorithm) for file in files]
+            for file, future in zip(files, futures):
+                try:
+                    print('%s  %s' % (future.result(), file))
+                except OSError as e:
+                    print('Error: %s: %s' % (file, e.strerror), file=sys.stderr)
+                    failed = True
+        if failed:
+            exit(1)
 
     def md5sum_cmd(self, args):
-        crypt = hashlib.md5()
-        for file in args:
-            with open(file, 'rb') as f:
-                crypt.update(f.read())
-            print('%s %s' % (crypt.hexdigest(), file))
+        self.checksum('md5', args)
+
+    def sha1sum_cmd(self, args):
+        self.checksum('sha1', args)
 
     def sha224sum_cmd(self, args):
-        crypt = hashlib.sha224()
-        for file in args:
-            with open(file, 'rb') as f:
-                crypt.update(f.read())
+        self.checksum('sha224', args)
 
     def sha256sum_cmd(self, args):
-        crypt = hashlib.sha256()
-        for file in args:
-            with open(file, 'rb') as f:
-                crypt.update(f.read())
+        self.checksum('sha256', args)
 
     def sha384sum_cmd(self, args):
-        crypt = hashlib.sha384()
-        for file in args:
-            with open(file, 'rb') as f:
-                crypt.update(f.read())
+        self.checksum('sha384', args)
 
     def sha512sum_cmd(self, args):
-        crypt = hashlib.md5()
-        for file in args:
-            with open(file, 'rb') as f:
-                crypt.update(f.read())
+        self.checksum('sha512', args)
 
     def remove_cmd(self, args):
         for file in args:
@@ -173,7 +511,20 @@ class CommandToolWrapper:
                 os.remove(file)
 
     def remove_directory_cmd(self, args):
-        rmtree(args[0])
+        failed = False
+        with ThreadPoolExecutor(max_workers=IO_WORKERS) as executor:
+            for dir in args:
+                try:
+                    # Like CMake, only the link is removed for a symbolic link to a directory
+                    if os.path.islink(dir):
+                        os.remove(dir)
+                    elif os.path.isdir(dir):
+                        remove_tree(dir, executor)
+                except OSError as e:
+                    print('Error removing directory "%s": %s' % (dir, e.strerror))
+                    failed = True
+        if failed:
+            exit(1)
 
     def rename_cmd(self, args):
         os.rename(args[0], args[1])
@@ -182,10 +533,207 @@ class CommandToolWrapper:
         self.cmake.server.run(args)
 
     def sleep_cmd(self, args):
-        sleep(float(args[0]))
+        try:
+            time.sleep(sum(float(arg) for arg in args))
+        except ValueError:
+            print('Error: Unknown sleep time format "%s".' % ' '.join(args))
+            exit(1)
 
     def tar_cmd(self, args):
-        raise NotImplementedError()
+        if not args:
+            print('Error: tar requires an argument')
+            exit(1)
+        flags = args[0].lstrip('-')
+        archive_format = None
+        paths = []
+        i = 1
+        while i < len(args):
+            if args[i] == '--':
+                paths += args[i + 1:]
+                break
+            elif args[i].startswith('--format='):
+                archive_format = args[i].split('=', 1)[1]
+                if archive_format != 'zip' and archive_format not in TAR_FORMATS:
+                    print('Error: Unknown -E tar --format= argument: ' + archive_format)
+                    exit(1)
+            elif args[i].startswith('--files-from='):
+                with open(args[i].split('=', 1)[1]) as file:
+                    paths += [line.rstrip('\n') for line in file if line.strip()]
+            elif args[i].startswith('-'):
+                print('Error: Unknown option to -E tar: ' + args[i])
+                exit(1)
+            else:
+                paths.append(args[i])
+            i += 1
+
+        if not paths:
+            print('Error: No archive file specified')
+            exit(1)
+        verbose = 'v' in flags
+        compressions = [TAR_COMPRESSIONS[flag] for flag in flags if flag in TAR_COMPRESSIONS]
+        if len(compressions) > 1:
+            print('Error: Can only compress a tar file one way; at most one flag of z, j, or J may be used')
+            exit(1)
+        compression = compressions[0] if compressions else ''
+
+        try:
+            if 'c' in flags:
+                if archive_format == 'zip':
+                    self.create_zip(paths[0], paths[1:], verbose)
+                else:
+                    self.create_tar(paths[0], paths[1:], compression,
+                                    TAR_FORMATS.get(archive_format, tarfile.PAX_FORMAT), verbose)
+            elif 'x' in flags or 't' in flags:
+                if zipfile.is_zipfile(paths[0]):
+                    self.read_zip(paths[0], paths[1:], 'x' in flags, verbose)
+                else:
+                    self.read_tar(paths[0], paths[1:], 'x' in flags, verbose)
+            else:
+                print('Error: tar: One of the arguments cx or t is required')
+                exit(1)
+        except (OSError, tarfile.TarError, zipfile.BadZipFile) as e:
+            print('Error: tar: %s' % e)
+            exit(1)
+
+    def walk_archive_paths(self, paths):
+        for path in paths:
+            yield path
+            if os.path.isdir(path) and not os.path.islink(path):
+                for root, dirs, files in os.walk(path):
+                    dirs.sort()
+                    for name in sorted(dirs) + sorted(files):
+                        yield os.path.join(root, name)
+
+    def prefetch_files(self, paths, chunks, follow_links):
+        """
+        Read the files to archive on a separate thread, so reading overlaps with compression.
+        The queue is bounded, so at most PREFETCH_CHUNKS chunks are held in memory.
+        """
+        try:
+            for path in self.walk_archive_paths(paths):
+                chunks.put(path)
+                if os.path.isfile(path) and (follow_links or not os.path.islink(path)):
+                    with open(path, 'rb') as file:
+                        for chunk in iter(lambda: file.read(CHUNK_SIZE), b''):
+                            chunks.put(chunk)
+                chunks.put(MEMBER_END)
+            chunks.put(ARCHIVE_END)
+        except Exception as e:
+            chunks.put(e)
+
+    def prefetched_members(self, paths, follow_links=False):
+        """
+        Yield every path to archive with a reader for its data.
+        """
+        chunks = queue.Queue(maxsize=PREFETCH_CHUNKS)
+        thread = threading.Thread(target=self.prefetch_files, args=(paths, chunks, follow_links), daemon=True)
+        thread.start()
+        while True:
+            path = chunks.get()
+            if path is ARCHIVE_END:
+                break
+            if isinstance(path, Exception):
+                raise path
+            reader = PrefetchReader(chunks)
+            yield path, reader
+            reader.drain()
+        thread.join()
+
+    def create_tar(self, file_name, paths, compression, tar_format, verbose):
+        # Stream mode writes the compressed archive sequentially without seeking
+        with tarfile.open(file_name, 'w|' + compression, format=tar_format) as archive:
+            for path, reader in self.prefetched_members(paths):
+                info = archive.gettarinfo(path)
+                if info is None:
+                    continue
+                if verbose:
+                    print('a ' + info.name)
+                archive.addfile(info, reader if info.isreg() else None)
+
+    def create_zip(self, file_name, paths, verbose):
+        with zipfile.ZipFile(file_name, 'w', zipfile.ZIP_DEFLATED, allowZip64=True) as archive:
+            for path, reader in self.prefetched_members(paths, follow_links=True):
+                if verbose:
+                    print('a ' + path)
+                if not hasattr(zipfile.ZipInfo, 'from_file'):
+                    # Python < 3.6 cannot stream into archive members
+                    archive.write(path)
+                    continue
+                info = zipfile.ZipInfo.from_file(path)
+                if info.is_dir():
+                    archive.writestr(info, b'')
+                else:
+                    info.compress_type = zipfile.ZIP_DEFLATED
+                    with archive.open(info, 'w', force_zip64=True) as member:
+                        shutil.copyfileobj(reader, member, CHUNK_SIZE)
+
+    def is_selected_member(self, name, selected):
+        name = name.rstrip('/')
+        return not selected or any(name == path or name.startswith(path + '/') for path in selected)
+
+    def read_tar(self, file_name, selected, extract, verbose):
+        selected = [path.rstrip('/') for path in selected]
+        # Reject absolute paths, links out of the destination and special files where supported
+        kwargs = {'filter': 'data'} if hasattr(tarfile, 'data_filter') else {}
+        with tarfile.open(file_name, 'r|*') as archive:
+            for member in archive:
+                if not self.is_selected_member(member.name, selected):
+                    continue
+                if not extract:
+                    print(member.name)
+                    continue
+                if verbose:
+                    print('x ' + member.name)
+                archive.extract(member, **kwargs)
+
+    def read_zip(self, file_name, selected, extract, verbose):
+        selected = [path.rstrip('/') for path in selected]
+        with zipfile.ZipFile(file_name) as archive:
+            for info in archive.infolist():
+                if not self.is_selected_member(info.filename, selected):
+                    continue
+                if extract:
+                    if verbose:
+                        print('x ' + info.filename)
+                    archive.extract(info)
+                else:
+                    print(info.filename)
+
+    def time_cmd(self, args):
+        """
+        Run a command and report its wall time, CPU time and peak memory, then exit with its status.
+        """
+        if not args:
+            print('Error: time requires a command')
+            exit(1)
+        sys.stdout.flush()
+        start = time.perf_counter()
+        try:
+            child = subprocess.Popen(args)
+        except OSError as e:
+            print('Error running "%s": %s' % (' '.join(args), e.strerror))
+            exit(1)
+
+        if not hasattr(os, 'wait4'):
+            # Resource usage of a single child is only available on Unix
+            code = child.wait()
+            print('Elapsed time: %.3f s. (time)' % (time.perf_counter() - start))
+            exit(code)
+
+        # Reap the command itself to get its own usage, RUSAGE_CHILDREN would include earlier children
+        pid, status, usage = os.wait4(child.pid, 0)
+        wall = time.perf_counter() - start
+        if hasattr(os, 'waitstatus_to_exitcode'):
+            child.returncode = os.waitstatus_to_exitcode(status)
+        else:
+            child.returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+        code = child.returncode
+        # ru_maxrss is in bytes on macOS, KiB elsewhere
+        max_rss = usage.ru_maxrss // 1024 if sys.platform == 'darwin' else usage.ru_maxrss
+        print('Elapsed time: %.3f s. (time), %.3f s. (user), %.3f s. (sys), %d KiB (max rss)' % (
+            wall, usage.ru_utime, usage.ru_stime, max_rss))
+        # Popen reports a command killed by a signal with the negative signal number
+        exit(128 - code if code < 0 else code)
 
     def touch_cmd(self, args):
         with open(args[0], 'a'):
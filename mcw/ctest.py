@@ -0,0 +1,556 @@
+import os
+import re
+import sys
+import json
+import time
+import shlex
+import random
+import signal
+import socket
+import logging
+import datetime
+import threading
+import subprocess
+import xml.etree.ElementTree as ETree
+from concurrent.futures import ThreadPoolExecutor
+
+from .meson import Meson
+
+# Exit codes of the Meson exitcode test protocol
+SKIP_RETURN_CODE = 77
+ERROR_RETURN_CODE = 99
+# CTest exits with this code when any test failed
+TESTS_FAILED_EXIT_CODE = 8
+
+# CTest status of each Meson test result
+RESULT_STATUS = {
+    'OK': 'Passed',
+    'EXPECTEDFAIL': 'Passed',
+    'SKIP': 'Skipped',
+    'FAIL': 'Failed',
+    'UNEXPECTEDPASS': 'Failed',
+    'ERROR': 'Failed',
+    'TIMEOUT': 'Timeout'
+}
+FAILED_RESULTS = ('FAIL', 'UNEXPECTEDPASS', 'ERROR', 'TIMEOUT')
+
+TAP_PLAN_REGEX = re.compile(r'^1\.\.(\d+)')
+TAP_TEST_REGEX = re.compile(r'^(not )?ok\b(?:[^#]*#\s*(SKIP|TODO)\b)?', re.IGNORECASE)
+# Characters XML 1.0 does not allow, even escaped
+XML_INVALID_REGEX = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f]')
+
+
+def get_test_properties(test, build_dir):
+    """
+    Get the CTest properties of a Meson test as (name, value) pairs.
+    """
+    properties = [('WORKING_DIRECTORY', test['workdir'] or build_dir)]
+    if test['timeout'] and test['timeout'] > 0:
+        properties.append(('TIMEOUT', test['timeout']))
+    if test['suite']:
+        properties.append(('LABELS', test['suite']))
+    if test['env']:
+        properties.append(('ENVIRONMENT', ['%s=%s' % (name, value) for name, value in sorted(test['env'].items())]))
+    if not test['is_parallel']:
+        properties.append(('RUN_SERIAL', True))
+    if test['should_fail']:
+        properties.append(('WILL_FAIL', True))
+    if test['protocol'] == 'exitcode':
+        properties.append(('SKIP_RETURN_CODE', SKIP_RETURN_CODE))
+    return properties
+
+
+class CTestWrapper:
+    """
+    Class that emulates CTest by running the tests of a Meson build dir.
+    Results are determined the way 'meson test' does, and reported the way CTest does.
+    """
+
+    def __init__(self):
+        self.version = [3, 10, 0]
+        self.command = 'test'
+        self.build_dir = os.getcwd()
+        self.config = None
+        self.tests_regex = None
+        self.exclude_regex = None
+        self.label_regex = None
+        self.label_exclude_regex = None
+        self.jobs = None
+        self.timeout = None
+        self.output_on_failure = bool(os.environ.get('CTEST_OUTPUT_ON_FAILURE'))
+        self.verbose = False
+        self.stop_on_failure = False
+        self.junit_file = None
+        self.meson = Meson()
+        self.logger = logging.getLogger('CTest')
+
+        # Shared by the test threads
+        self.print_lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.completed = 0
+        self.total = 0
+        self.number_width = 0
+        self.name_width = 0
+
+    def run(self, args):
+        try:
+            self.parse_args(args)
+            getattr(self, self.command + '_cmd')()
+        except RuntimeError as e:
+            print(e.args[0])
+            exit(1)
+
+    def parse_args(self, args):
+        i = 1
+        while i < len(args):
+            if args[i] in ('-version', '--version'):
+                self.command = 'version'
+            elif args[i] in ('-h', '-help', '--help'):
+                self.command = 'help'
+            elif args[i] in ('-R', '--tests-regex'):
+                i += 1
+                self.tests_regex = self.compile_regex(args[i])
+            elif args[i] in ('-E', '--exclude-regex'):
+                i += 1
+                self.exclude_regex = self.compile_regex(args[i])
+            elif args[i] in ('-L', '--label-regex'):
+                i += 1
+                self.label_regex = self.compile_regex(args[i])
+            elif args[i] in ('-LE', '--label-exclude'):
+                i += 1
+                self.label_exclude_regex = self.compile_regex(args[i])
+            elif args[i] in ('-j', '--parallel'):
+                # Without a number, all processors are used
+                if i + 1 < len(args) and args[i + 1].isdigit():
+                    i += 1
+                    self.jobs = int(args[i])
+                else:
+                    self.jobs = os.cpu_count() or 1
+            elif args[i].startswith('-j') and args[i][2:].isdigit():
+                self.jobs = int(args[i][2:])
+            elif args[i] == '--timeout':
+                i += 1
+                self.timeout = float(args[i])
+            elif args[i] == '--output-on-failure':
+                self.output_on_failure = True
+            elif args[i] in ('-V', '--verbose', '-VV', '--extra-verbose'):
+                self.verbose = True
+            elif args[i] in ('-N', '--show-only', '--show-only=human'):
+                self.command = 'show_only'
+            elif args[i] == '--show-only=json-v1':
+                self.command = 'show_only_json'
+            elif args[i].startswith('--show-only='):
+                raise RuntimeError('CMake Error: \'--show-only=\' given unknown value \'%s\'' % args[i].split('=', 1)[1])
+            elif args[i] == '--output-junit':
+                i += 1
+                self.junit_file = os.path.abspath(args[i])
+            elif args[i] == '--stop-on-failure':
+                self.stop_on_failure = True
+            elif args[i] in ('-C', '--build-config'):
+                i += 1
+                self.config = args[i]
+            elif args[i] == '--test-dir':
+                i += 1
+                self.build_dir = os.path.abspath(args[i])
+            elif args[i] in ('-T', '--test-action', '-D', '--dashboard'):
+                # Dashboard actions other than running the tests are not supported
+                i += 1
+            elif args[i] in ('--no-compress-output', '--no-label-summary', '--force-new-ctest-process', '--progress',
+                             '-Q', '--quiet'):
+                pass
+            else:
+                raise RuntimeError('CMake Error: Unknown argument: ' + args[i])
+            i += 1
+
+        if self.jobs is None:
+            # Fall back to the job count CTest or 'meson test' read from the environment
+            for name in ('CTEST_PARALLEL_LEVEL', 'MESON_TESTTHREADS'):
+                if os.environ.get(name, '').isdigit():
+                    self.jobs = int(os.environ[name])
+                    break
+            else:
+                self.jobs = os.cpu_count() or 1
+        self.jobs = max(self.jobs, 1)
+
+    def compile_regex(self, pattern):
+        try:
+            return re.compile(pattern)
+        except re.error as e:
+            raise RuntimeError('CMake Error: Invalid regular expression "%s": %s' % (pattern, e))
+
+    def log(self, msg, *args, level=logging.INFO):
+        if isinstance(msg, Exception):
+            self.logger.error(msg, exc_info=msg)
+        else:
+            self.logger.log(level, msg, *args)
+
+    def version_cmd(self):
+        print('ctest version {0}'.format('.'.join(map(str, self.version))))
+
+    def help_cmd(self):
+        print('Usage\n')
+        print('  ctest [options]\n')
+        print('Runs the tests of a Meson build directory.\n')
+        print('Options')
+        print('  -C <cfg>, --build-config <cfg> = Choose configuration to test.')
+        print('  --test-dir <dir>             = Specify the directory in which to look for tests.')
+        print('  -R <regex>, --tests-regex <regex> = Run tests matching regular expression.')
+        print('  -E <regex>, --exclude-regex <regex> = Exclude tests matching regular expression.')
+        print('  -L <regex>, --label-regex <regex> = Run tests with labels (Meson suites) matching')
+        print('                                 regular expression.')
+        print('  -LE <regex>, --label-exclude <regex> = Exclude tests with labels matching regular expression.')
+        print('  -j <jobs>, --parallel <jobs> = Run the tests in parallel using the given number of jobs,')
+        print('                                 defaults to the number of processors.')
+        print('  --timeout <seconds>          = Set the timeout of tests without one.')
+        print('  --stop-on-failure            = Stop running the tests after one has failed.')
+        print('  --output-on-failure          = Output anything output by the test program if the test')
+        print('                                 should fail.')
+        print('  -V, --verbose                = Enable verbose output from tests.')
+        print('  -N, --show-only[=<format>]   = Disable actual execution of tests. Supported formats: human,')
+        print('                                 json-v1')
+        print('  --output-junit <file>        = Output test results to JUnit XML file.')
+        print('  --version                    = Print version number and exit.\n')
+        print('Results are also written to meson-logs/testlog-ctest.json in the format of \'meson test\'.')
+
+    def init_meson(self):
+        """
+        Find the Meson build dir of the configuration to test.
+        Configurations other than the active one live in sibling build dirs at <build-dir>-<config>.
+        """
+        build_dir = self.build_dir
+        if self.config and os.path.isdir(os.path.join(build_dir + '-' + self.config, 'meson-info')):
+            build_dir = build_dir + '-' + self.config
+        if not os.path.isdir(os.path.join(build_dir, 'meson-info')):
+            raise RuntimeError('*********************************\n'
+                               'No test configuration file found!\n'
+                               '*********************************')
+
+        self.meson.build_dir = build_dir
+        self.meson.logger = logging.getLogger('Meson')
+        self.log('(build_dir) "%s"', build_dir)
+
+    def get_tests(self):
+        """
+        Get (number, test) pairs of the selected tests.
+        Like in CTest, tests are numbered by their position among all tests.
+        """
+        tests = []
+        for number, test in enumerate(self.meson.get_tests(), 1):
+            if self.tests_regex and not self.tests_regex.search(test['name']):
+                continue
+            if self.exclude_regex and self.exclude_regex.search(test['name']):
+                continue
+            if self.label_regex and not any(self.label_regex.search(suite) for suite in test['suite']):
+                continue
+            if self.label_exclude_regex and any(self.label_exclude_regex.search(suite) for suite in test['suite']):
+                continue
+            tests.append((number, test))
+        return tests
+
+    def show_only_cmd(self):
+        self.init_meson()
+        tests = self.get_tests()
+        number_width = len(str(max([number for number, _ in tests] or [0])))
+
+        print('Test project %s' % self.meson.build_dir)
+        for number, test in tests:
+            print('  Test %s: %s' % (('#%d' % number).rjust(number_width + 1), test['name']))
+        print('\nTotal Tests: %d' % len(tests))
+
+    def show_only_json_cmd(self):
+        self.init_meson()
+        tests = []
+        for _, test in self.get_tests():
+            info = {
+                'name': test['name'],
+                'command': test['cmd'],
+                'properties': [{'name': name, 'value': value}
+                               for name, value in get_test_properties(test, self.meson.build_dir)]
+            }
+            if self.config:
+                info['config'] = self.config
+            tests.append(info)
+
+        print(json.dumps({
+            'kind': 'ctestInfo',
+            'version': {'major': 1, 'minor': 0},
+            'backtraceGraph': {'commands': [], 'files': [], 'nodes': []},
+            'tests': tests
+        }, indent=2))
+
+    def test_cmd(self):
+        self.init_meson()
+        tests = self.get_tests()
+
+        print('Test project %s' % self.meson.build_dir, flush=True)
+        if not tests:
+            print('No tests were found!!!')
+            return
+
+        start = time.perf_counter()
+        results = self.run_tests(tests)
+        duration = time.perf_counter() - start
+
+        self.print_summary(results, duration)
+        self.write_json_log(results)
+        if self.junit_file:
+            self.write_junit(results, duration)
+
+        if any(result['result'] in FAILED_RESULTS for result in results):
+            print('Errors while running CTest')
+            exit(TESTS_FAILED_EXIT_CODE)
+
+    def run_tests(self, tests):
+        """
+        Run tests on a pool of threads, each one waiting on its test process.
+        Like in 'meson test', a test that is not parallel runs once the tests before it have finished,
+        and no other test runs alongside it.
+        """
+        self.completed = 0
+        self.total = len(tests)
+        self.number_width = len(str(max(number for number, _ in tests)))
+        self.name_width = max(len(test['name']) for _, test in tests)
+
+        results = []
+        running = []
+        with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            for number, test in tests:
+                if test['is_parallel'] and self.jobs > 1:
+                    running.append(executor.submit(self.run_test, number, test))
+                    continue
+                results.extend(future.result() for future in running)
+                running = []
+                results.append(self.run_test(number, test))
+            results.extend(future.result() for future in running)
+
+        # Tests skipped by --stop-on-failure have no result
+        return sorted((result for result in results if result), key=lambda result: result['number'])
+
+    def run_test(self, number, test):
+        if self.stopped.is_set():
+            return None
+
+        env = os.environ.copy()
+        env.update(test['env'])
+        # Like 'meson test', expose use of uninitialized memory unless the environment sets MALLOC_PERTURB_
+        if not env.get('MALLOC_PERTURB_'):
+            env['MALLOC_PERTURB_'] = str(random.randint(1, 255))
+
+        # The timeout of a Meson test takes precedence, 0 disables it
+        timeout = test['timeout'] if test['timeout'] and test['timeout'] > 0 else self.timeout
+
+        with self.print_lock:
+            print('      Start %s: %s' % (str(number).rjust(self.number_width), test['name']), flush=True)
+        if self.verbose:
+            self.print_output(number, 'Test command: %s\n' % ' '.join(shlex.quote(arg) for arg in test['cmd']))
+
+        result = {
+            'name': test['name'],
+            'number': number,
+            'starttime': time.time(),
+            'command': test['cmd'],
+            'env': test['env'],
+            'timeout': timeout
+        }
+        start = time.perf_counter()
+        timed_out = threading.Event()
+        output = []
+        try:
+            process = subprocess.Popen(test['cmd'], stdout=subprocess.PIPE, stderr=subprocess.STDOUT, env=env,
+                                       cwd=test['workdir'] or self.meson.build_dir,
+                                       start_new_session=os.name != 'nt')
+        except OSError as e:
+            output.append('Could not run test: %s\n' % e)
+            returncode = None
+        else:
+            timer = None
+            if timeout:
+                timer = threading.Timer(timeout, self.kill_test, (process, timed_out))
+                timer.start()
+            # Output is streamed line by line, so verbose output shows up while the test runs
+            for line in process.stdout:
+                line = line.decode('utf-8', 'replace')
+                output.append(line)
+                if self.verbose:
+                    self.print_output(number, line)
+            process.stdout.close()
+            returncode = process.wait()
+            if timer:
+                timer.cancel()
+
+        result['duration'] = time.perf_counter() - start
+        result['returncode'] = returncode
+        result['stdout'] = ''.join(output)
+        result['result'] = self.get_result(test, returncode, result['stdout'], timed_out.is_set())
+
+        failed = result['result'] in FAILED_RESULTS
+        if failed and self.stop_on_failure:
+            self.stopped.set()
+        self.print_result(result, failed)
+        return result
+
+    def kill_test(self, process, timed_out):
+        """
+        Kill a test process that timed out, along with any processes it started.
+        """
+        timed_out.set()
+        try:
+            if os.name == 'nt':
+                process.kill()
+            else:
+                os.killpg(process.pid, signal.SIGKILL)
+        except OSError:
+            pass
+
+    def get_result(self, test, returncode, output, timed_out):
+        """
+        Get the Meson test result of a test run, determined the way 'meson test' does.
+        """
+        if timed_out:
+            return 'TIMEOUT'
+        if returncode is None:
+            return 'ERROR'
+
+        if test['protocol'] == 'tap':
+            result = self.get_tap_result(returncode, output)
+        elif returncode == SKIP_RETURN_CODE:
+            result = 'SKIP'
+        elif returncode == ERROR_RETURN_CODE:
+            result = 'ERROR'
+        else:
+            result = 'FAIL' if returncode else 'OK'
+
+        if test['should_fail'] and result in ('OK', 'FAIL'):
+            result = 'UNEXPECTEDPASS' if result == 'OK' else 'EXPECTEDFAIL'
+        return result
+
+    def get_tap_result(self, returncode, output):
+        if returncode != 0:
+            return 'ERROR'
+
+        plan = None
+        results = []
+        for line in output.splitlines():
+            if line.startswith('Bail out!'):
+                return 'ERROR'
+            match = TAP_PLAN_REGEX.match(line)
+            if match:
+                plan = int(match.group(1))
+                continue
+            match = TAP_TEST_REGEX.match(line)
+            if not match:
+                continue
+            ok = not match.group(1)
+            directive = (match.group(2) or '').upper()
+            if directive == 'SKIP':
+                results.append('SKIP' if ok else 'FAIL')
+            elif directive == 'TODO':
+                results.append('UNEXPECTEDPASS' if ok else 'EXPECTEDFAIL')
+            else:
+                results.append('OK' if ok else 'FAIL')
+
+        if plan is not None and plan != len(results):
+            return 'ERROR'
+        if all(result == 'SKIP' for result in results):
+            return 'SKIP'
+        if any(result in FAILED_RESULTS for result in results):
+            return 'FAIL'
+        return 'OK'
+
+    def print_output(self, number, text):
+        if not text.endswith('\n'):
+            text += '\n'
+        with self.print_lock:
+            sys.stdout.write(''.join('%d: %s' % (number, line) for line in text.splitlines(True)))
+            sys.stdout.flush()
+
+    def print_result(self, result, failed):
+        status = RESULT_STATUS[result['result']]
+        if status != 'Passed':
+            status = '***' + status
+
+        with self.print_lock:
+            self.completed += 1
+            print('%s/%d Test %s: %s %s %s %7.2f sec' % (
+                str(self.completed).rjust(self.number_width), self.total,
+                ('#%d' % result['number']).rjust(self.number_width + 1), result['name'],
+                '.' * (self.name_width - len(result['name']) + 3), status.rjust(10), result['duration']))
+            if failed and self.output_on_failure and result['stdout']:
+                sys.stdout.write(result['stdout'] if result['stdout'].endswith('\n') else result['stdout'] + '\n')
+            sys.stdout.flush()
+
+    def print_summary(self, results, duration):
+        failed = [result for result in results if result['result'] in FAILED_RESULTS]
+        skipped = [result for result in results if result['result'] == 'SKIP']
+
+        # Like CTest, skipped tests count as passed and any failure keeps the rate below 100%
+        percent = (len(results) - len(failed)) * 100 / len(results) if results else 100
+        if failed and percent > 99:
+            percent = 99
+        print('\n%.0f%% tests passed, %d tests failed out of %d' % (percent, len(failed), len(results)))
+        print('\nTotal Test time (real) = %7.2f sec' % duration)
+
+        if skipped:
+            print('\nThe following tests did not run:')
+            for result in skipped:
+                print('\t%s - %s (Skipped)' % (str(result['number']).rjust(3), result['name']))
+        if failed:
+            print('\nThe following tests FAILED:')
+            for result in failed:
+                print('\t%s - %s (%s)' % (str(result['number']).rjust(3), result['name'],
+                                          RESULT_STATUS[result['result']]))
+
+    def write_json_log(self, results):
+        """
+        Write the results as JSON lines in the format of the 'meson test' log.
+        """
+        log_dir = os.path.join(self.meson.build_dir, 'meson-logs')
+        if not os.path.isdir(log_dir):
+            return
+        with open(os.path.join(log_dir, 'testlog-ctest.json'), 'w') as file:
+            for result in results:
+                file.write(json.dumps({
+                    'name': result['name'],
+                    'stdout': result['stdout'],
+                    'result': result['result'],
+                    'starttime': result['starttime'],
+                    'duration': result['duration'],
+                    'returncode': result['returncode'],
+                    'env': result['env'],
+                    'command': result['command']
+                }) + '\n')
+
+    def write_junit(self, results, duration):
+        failures = sum(1 for result in results if result['result'] in FAILED_RESULTS)
+        skipped = sum(1 for result in results if result['result'] == 'SKIP')
+
+        root = ETree.Element('testsuite', {
+            'name': self.meson.get_project_name(),
+            'tests': str(len(results)),
+            'failures': str(failures),
+            'disabled': '0',
+            'skipped': str(skipped),
+            'hostname': socket.gethostname(),
+            'time': '%.3f' % duration,
+            'timestamp': datetime.datetime.now().replace(microsecond=0).isoformat()
+        })
+        for result in results:
+            if result['result'] in FAILED_RESULTS:
+                status = 'fail'
+            elif result['result'] == 'SKIP':
+                status = 'notrun'
+            else:
+                status = 'run'
+            testcase = ETree.SubElement(root, 'testcase', {
+                'name': result['name'],
+                'classname': result['name'],
+                'time': '%.3f' % result['duration'],
+                'status': status
+            })
+            if status == 'fail':
+                ETree.SubElement(testcase, 'failure', {'message': RESULT_STATUS[result['result']]})
+            elif status == 'notrun':
+                ETree.SubElement(testcase, 'skipped', {'message': 'SKIP_RETURN_CODE=%d' % SKIP_RETURN_CODE})
+            ETree.SubElement(testcase, 'system-out').text = XML_INVALID_REGEX.sub('', result['stdout'])
+
+        ETree.ElementTree(root).write(self.junit_file, encoding='utf-8', xml_declaration=True)
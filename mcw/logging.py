@@ -1,12 +1,85 @@
-import logging
+import time
+import queue
+import threading
+from logging.handlers import QueueHandler
 
+# Records are coalesced for this many seconds, so at most one message is sent per interval
+BATCH_INTERVAL = 0.1
+BATCH_MAX_RECORDS = 200
+# Longer records, such as introspection payloads, are truncated before they are queued
+RECORD_MAX_LENGTH = 2000
+
+
+class ServerLogHandler(QueueHandler):
+    """
+    Class that forwards log records to the server client.
+    Records are queued and sent as batched messages from a background thread,
+    so logging never blocks on the client socket.
+    """
 
-class ServerLogHandler(logging.Handler):
     def __init__(self, server):
-        super().__init__()
+        super().__init__(queue.Queue())
         self.server = server
+        self.thread = None
+        self.thread_lock = threading.Lock()
+
+    def prepare(self, record):
+        record = super().prepare(record)
+        if len(record.msg) > RECORD_MAX_LENGTH:
+            record.msg = '%s... (%d more characters)' % (record.msg[:RECORD_MAX_LENGTH],
+                                                         len(record.msg) - RECORD_MAX_LENGTH)
+        return record
+
+    def enqueue(self, record):
+        with self.thread_lock:
+            if not self.thread:
+                self.thread = threading.Thread(target=self.forward_records, name='mcw-log-forwarder', daemon=True)
+                self.thread.start()
+        self.queue.put_nowait(record)
+
+    def forward_records(self):
+        stop = False
+        while not stop:
+            records = [self.queue.get()]
+            deadline = time.monotonic() + BATCH_INTERVAL
+            while records[-1] is not None and len(records) < BATCH_MAX_RECORDS:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    records.append(self.queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+
+            if records[-1] is None:
+                stop = True
+                records.pop()
+            try:
+                self.send(records)
+            finally:
+                for _ in range(len(records) + stop):
+                    self.queue.task_done()
+
+    def send(self, records):
+        if not records or not self.server.connected:
+            return
+        try:
+            self.server.send_message('\n'.join(record.msg for record in records), log=False)
+        except OSError:
+            pass
+
+    def flush(self):
+        """
+        Wait until every queued record has been forwarded.
+        """
+        if self.thread:
+            self.queue.join()
 
-    def emit(self, record):
-        log_entry = self.format(record)
-        if self.server.connected:
-            self.server.send_message(log_entry, log=False)
+    def close(self):
+        with self.thread_lock:
+            thread = self.thread
+            self.thread = None
+        if thread:
+            self.queue.put_nowait(None)
+            thread.join()
+        super().close()
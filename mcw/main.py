@@ -1,9 +1,19 @@
+import os
 import sys
 from .cmake import CMakeWrapper
+from .ctest import CTestWrapper
 
 
 def main():
-    CMakeWrapper().run(sys.argv)
+    # Installed or linked as ctest, emulate CTest instead of CMake
+    if 'ctest' in os.path.basename(sys.argv[0]):
+        ctest_main()
+    else:
+        CMakeWrapper().run(sys.argv)
+
+
+def ctest_main():
+    CTestWrapper().run(sys.argv)
 
 
 if __name__ == "__main__":
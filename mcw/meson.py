@@ -1,8 +1,13 @@
 import os
 import json
+import shlex
+import shutil
+import logging
 import subprocess
 
 from .ninja import NinjaBackend
+from .trace import Tracer
+from .util import load_pickle, save_pickle
 
 
 class Meson:
@@ -17,6 +22,8 @@ class Meson:
         self.source_dir = None
         self.build_type = None
         self.cross_file = None
+        self.options = {}
+        self.tracer = Tracer()
 
         # Cache
         self.c_version = None
@@ -27,50 +34,134 @@ class Meson:
         self.c_project_info = None
         self.c_compile_commands = None
         self.c_compile_commands_target = {}
+        self.c_compile_commands_index = None
         self.c_default_inc_dirs = {}
-
-    def log(self, msg):
+        self.c_build_options = None
+        self.c_output_targets = None
+        self.c_tests = None
+        self.c_header_index = None
+        self.c_subproject_dirs = None
+        self.c_cached = {}
+
+    def log(self, msg, *args, level=logging.INFO):
         if isinstance(msg, Exception):
-            self.logger.info(msg, exc_info=msg)
+            self.logger.error(msg, exc_info=msg)
         else:
-            self.logger.info(msg)
+            self.logger.log(level, msg, *args)
 
     def call(self, args, show=False):
-        child = subprocess.Popen([self.path] + args, stdout=subprocess.PIPE)
-        fulloutput = b''
-        while True:
-            output = child.stdout.readline()
-            if output == b'' and child.poll() is not None:
-                break
-            if output:
-                if show:
-                    print(output.decode("utf-8"), end='')
-                fulloutput += output
-        fulloutput = fulloutput.decode("utf-8")
+        with self.tracer.span('meson ' + args[0], 'meson', args=args):
+            child = subprocess.Popen([self.path] + args, stdout=subprocess.PIPE)
+            fulloutput = b''
+            while True:
+                output = child.stdout.readline()
+                if output == b'' and child.poll() is not None:
+                    break
+                if output:
+                    if show:
+                        print(output.decode("utf-8"), end='')
+                    fulloutput += output
+            fulloutput = fulloutput.decode("utf-8")
         if child.poll() != 0:
             raise RuntimeError(fulloutput)
         return fulloutput
 
+    def clone(self, build_dir, build_type):
+        """
+        Create a Meson instance sharing this one's settings for another build dir.
+        """
+        meson = Meson(self.path)
+        meson.logger = self.logger
+        meson.tracer = self.tracer
+        meson.build_dir = build_dir
+        meson.source_dir = self.source_dir
+        meson.build_type = build_type
+        meson.cross_file = self.cross_file
+        meson.options = dict(self.options)
+        if self.backend:
+            meson.backend = type(self.backend)(meson)
+        return meson
+
     def set_backend(self, backend):
         if backend == 'ninja':
             self.backend = NinjaBackend(self)
         else:
             raise RuntimeError('Backend not supported: ' + backend)
 
-    def setup(self):
+    def setup(self, show=True):
         if not self.backend:
             raise RuntimeError('Build is not initilized')
         if self.backend.setup():
+            # A changed cross file can only be applied by wiping the build dir
+            setup_cross_files = self.load_setup_state().get('cross_files')
+            cross_files = self.get_cross_files()
+            if cross_files and cross_files != setup_cross_files:
+                self.call(['setup', '--wipe'] + self.get_options() + [self.source_dir, self.build_dir], show)
+                self.clear_cache()
+                self.save_setup_state(cross_files=cross_files)
+            elif setup_cross_files and not cross_files:
+                # 'meson setup --wipe' keeps the previous cross files unless new ones are passed
+                self.log('The cross file of an existing build dir cannot be removed, delete the build dir instead',
+                         level=logging.WARNING)
+        else:
+            meson_file = os.path.join(self.source_dir, 'meson.build')
+            if not os.path.exists(meson_file):
+                raise RuntimeError('No meson.build in source directory!')
+
+            self.call(['setup'] + self.get_options() + [self.source_dir, self.build_dir], show)
+            self.save_setup_state(cross_files=self.get_cross_files())
+
+        self.configure(show)
+
+    def configure(self, show=True):
+        """
+        Apply changed options to the build dir with a single 'meson configure' call.
+        The options are only compared with those of the build dir when they differ from the ones applied last.
+        """
+        state = self.load_setup_state()
+        requested_options = self.get_requested_options()
+        if state.get('options') == requested_options:
             return
 
-        meson_file = os.path.join(self.source_dir, 'meson.build')
-        if not os.path.exists(meson_file):
-            raise RuntimeError('No meson.build in source directory!')
-
-        self.call(['setup'] + self.get_options() + [self.source_dir, self.build_dir], True)
+        changed_options = self.get_changed_options()
+        if changed_options:
+            args = ['-D%s=%s' % (name, self.format_option(value)) for name, value in sorted(changed_options.items())]
+            self.call(['configure'] + args + [self.build_dir], show)
+            self.clear_cache()
+        state['options'] = requested_options
+        self.save_setup_state(**state)
+
+    def load_setup_state(self):
+        """
+        Get the cross files and options mcw last applied to the build dir.
+        It is kept in meson-private, so wiping the build dir clears it.
+        """
+        return load_pickle(os.path.join(self.build_dir, 'meson-private', 'mcw-setup.pk1')) or {}
+
+    def save_setup_state(self, **state):
+        state = dict(self.load_setup_state(), **state)
+        save_pickle(os.path.join(self.build_dir, 'meson-private', 'mcw-setup.pk1'), state)
+
+    def clear_cache(self):
+        self.c_project_name = None
+        self.c_targets = None
+        self.c_target_files = {}
+        self.c_buildsystem_files = None
+        self.c_project_info = None
+        self.c_compile_commands = None
+        self.c_compile_commands_target = {}
+        self.c_compile_commands_index = None
+        self.c_default_inc_dirs = {}
+        self.c_build_options = None
+        self.c_output_targets = None
+        self.c_tests = None
+        self.c_header_index = None
+        self.c_subproject_dirs = None
+        if self.backend:
+            self.backend.clear_cache()
 
-    def build(self, target):
-        return self.backend.build(target)
+    def build(self, targets, jobs=None, clean_first=False, args=()):
+        return self.backend.build(targets, jobs, clean_first, args)
 
     def get_version(self):
         if not self.c_version:
@@ -79,20 +170,42 @@ class Meson:
 
     def get_project_name(self):
         if not self.c_project_name:
-            if self.get_version()[1] >= 49:
-                attr = 'descriptive_name'
+            # Meson 0.49.0 and later report the descriptive name
+            project_info = self.get_project_info()
+            if 'descriptive_name' in project_info:
+                self.c_project_name = project_info['descriptive_name']
             else:
-                attr = 'name'
-            self.c_project_name = self.get_project_info()[attr]
+                self.c_project_name = project_info['name']
         return self.c_project_name
 
     def get_targets(self):
         if not self.c_targets:
-            output = self.call(['introspect', '--targets', self.build_dir])
-            self.log('(targets) "%s"' % output)
-            self.c_targets = json.loads(output)
+            self.c_targets = self.introspect('targets')
+            self.log('(targets) "%s"', self.c_targets, level=logging.DEBUG)
         return self.c_targets
 
+    def get_tests(self):
+        if not self.c_tests:
+            self.c_tests = self.introspect('tests')
+
+            # Introspection leaves out should_fail, so it is read from the test setup 'meson test' loads.
+            # Unpickling it needs the modules of Meson, which may be installed for another Python.
+            should_fail = {}
+            try:
+                test_setup = load_pickle(os.path.join(self.build_dir, 'meson-private', 'meson_test_setup.dat'))
+            except (ImportError, AttributeError) as e:
+                test_setup = None
+                self.log('(test setup) Cannot load the Meson test setup: %s', e, level=logging.DEBUG)
+            if test_setup is None and self.c_tests:
+                self.log('Tests that should fail are unknown, as the Meson test setup cannot be loaded',
+                         level=logging.WARNING)
+            for test in test_setup or []:
+                should_fail[(test.name, tuple(test.suite))] = getattr(test, 'should_fail', False)
+            for test in self.c_tests:
+                test['should_fail'] = should_fail.get((test['name'], tuple(test['suite'])), False)
+            self.log('(tests) "%s"', self.c_tests, level=logging.DEBUG)
+        return self.c_tests
+
     def get_target_files(self, target):
         id = target['id']
         if id == 'all' or target['type'] in ('run', 'custom'):
@@ -108,9 +221,9 @@ class Meson:
             return self.c_target_files[id]
 
         # Handle meson versions before 0.50.0
-        self.log('(target) "%s"' % id)
+        self.log('(target) "%s"', id, level=logging.DEBUG)
         output = self.call(['introspect', '--target-files', id, self.build_dir])
-        self.log('(target files) "%s"' % output)
+        self.log('(target files) "%s"', output, level=logging.DEBUG)
 
         # Workaround https://github.com/mesonbuild/meson/issues/2783
         if output == '':
@@ -121,27 +234,111 @@ class Meson:
 
     def get_buildsystem_files(self):
         if not self.c_buildsystem_files:
-            output = self.call(['introspect', '--buildsystem-files', self.build_dir])
-            self.log('(buildsystem files) "%s"' % output)
-            self.c_buildsystem_files = json.loads(output)
+            self.c_buildsystem_files = self.introspect('buildsystem_files')
+            self.log('(buildsystem files) "%s"', self.c_buildsystem_files, level=logging.DEBUG)
         return self.c_buildsystem_files
 
+    def get_fingerprint(self):
+        """
+        Fingerprint of the build dir that changes whenever Meson regenerates it.
+        """
+        fingerprint = []
+        for name in ('build.ninja', os.path.join('meson-info', 'meson-info.json')):
+            path = os.path.join(self.build_dir, name)
+            if os.path.exists(path):
+                stat = os.stat(path)
+                fingerprint.append((name, stat.st_mtime_ns, stat.st_size))
+        return tuple(fingerprint)
+
+    def get_cached(self, name, func):
+        """
+        Get the result of func, cached in the build dir until the build fingerprint changes.
+        """
+        fingerprint = self.get_fingerprint()
+        # Results are also kept in memory, so a server answers repeated requests without loading them again
+        if name in self.c_cached and self.c_cached[name][0] == fingerprint:
+            return self.c_cached[name][1]
+
+        cache_file = os.path.join(self.build_dir, 'meson-private', 'mcw-%s.pk1' % name)
+        cached = load_pickle(cache_file)
+        if cached and cached[0] == fingerprint:
+            value = cached[1]
+        else:
+            value = func()
+            if os.path.isdir(os.path.dirname(cache_file)):
+                save_pickle(cache_file, (fingerprint, value))
+        self.c_cached[name] = (fingerprint, value)
+        return value
+
+    def get_target_outputs(self, target):
+        # Meson 0.50.0 and later list all outputs of a target as absolute paths
+        filenames = target['filename'] if isinstance(target['filename'], list) else [target['filename']]
+        return [os.path.relpath(os.path.join(self.build_dir, filename), self.build_dir) for filename in filenames]
+
+    def introspect(self, name):
+        # Meson 0.50.0 and later write introspection files on setup
+        info_file = os.path.join(self.build_dir, 'meson-info', 'intro-%s.json' % name)
+        if os.path.exists(info_file):
+            with open(info_file) as file:
+                return json.load(file)
+        return json.loads(self.call(['introspect', '--' + name.replace('_', '-'), self.build_dir]))
+
+    def get_build_options(self):
+        if not self.c_build_options:
+            self.c_build_options = self.introspect('buildoptions')
+        return self.c_build_options
+
     def get_project_info(self):
         if not self.c_project_info:
-            output = self.call(['introspect', '--projectinfo', self.build_dir])
-            self.log('(project info) "%s"' % output)
-            self.c_project_info = json.loads(output)
+            self.c_project_info = self.introspect('projectinfo')
+            self.log('(project info) "%s"', self.c_project_info, level=logging.DEBUG)
         return self.c_project_info
 
+    def get_install_dir(self):
+        """
+        Get the prefix Meson is installed to, e.g. /usr for /usr/bin/meson, or None if it is not found.
+        """
+        path = shutil.which(self.path)
+        if not path:
+            return None
+        return os.path.dirname(os.path.dirname(os.path.realpath(path)))
+
+    def get_subprojects(self):
+        return self.get_project_info().get('subprojects', [])
+
+    def get_subproject_dir(self, subproject):
+        """
+        Get the dir of a subproject relative to the source and build dirs.
+        """
+        if self.c_subproject_dirs is None:
+            subproject_dir = self.get_project_info().get('subproject_dir', 'subprojects')
+            self.c_subproject_dirs = {}
+            # Subprojects from wraps may be in dirs named after their version, which only target definitions show
+            for target in self.get_targets():
+                if not target.get('subproject') or 'defined_in' not in target:
+                    continue
+                path = os.path.relpath(target['defined_in'], self.source_dir)
+                if path.startswith(os.path.join(subproject_dir, '')):
+                    dir_name = path[len(subproject_dir) + 1:].split(os.sep)[0]
+                    self.c_subproject_dirs.setdefault(target['subproject'], os.path.join(subproject_dir, dir_name))
+            for project in self.get_subprojects():
+                self.c_subproject_dirs.setdefault(project['name'], os.path.join(subproject_dir, project['name']))
+        return self.c_subproject_dirs.get(subproject)
+
+    def load_compile_commands(self):
+        if not self.c_compile_commands:
+            compile_commands_file = os.path.join(self.build_dir, 'compile_commands.json')
+            if not os.path.exists(compile_commands_file):
+                raise RuntimeError('No compile_commands.json in build dir: ' + self.build_dir)
+            with self.tracer.span('compile_commands.json', 'parse'):
+                with open(compile_commands_file) as file:
+                    self.c_compile_commands = json.load(file)
+        return self.c_compile_commands
+
     def get_compile_commands(self, target):
         id = target['id']
         if id not in self.c_compile_commands_target:
-            if not self.c_compile_commands:
-                compile_commands_file = os.path.join(self.build_dir, 'compile_commands.json')
-                if not os.path.exists(compile_commands_file):
-                    Exception('No compile_commands.json in build dir')
-                json_data = open(compile_commands_file).read()
-                self.c_compile_commands = json.loads(json_data)
+            self.load_compile_commands()
             # Only way to identify target compiler commands from compile_commands.json
             # is by using a file from the wanted target
             if len(self.get_target_files(target)) == 0:
@@ -150,6 +347,54 @@ class Meson:
             self.c_compile_commands_target[id] = next((cmd for cmd in self.c_compile_commands if cmd['file'] == target_file), None)
         return self.c_compile_commands_target[id]
 
+    def get_compile_commands_index(self):
+        """
+        Get the compile commands by absolute source path, a source is compiled once per target using it.
+        """
+        if self.c_compile_commands_index is None:
+            self.c_compile_commands_index = self.get_cached('compile-commands-index', self.build_compile_commands_index)
+        return self.c_compile_commands_index
+
+    def build_compile_commands_index(self):
+        index = {}
+        for entry in self.load_compile_commands():
+            source = os.path.normpath(os.path.join(entry['directory'], entry['file']))
+            index.setdefault(source, []).append(entry)
+        return index
+
+    def get_compile_args(self, entry):
+        if 'arguments' in entry:
+            return entry['arguments']
+        return shlex.split(entry['command'])
+
+    def get_compile_output(self, entry):
+        """
+        Get the output of a compile command relative to the build dir, or None.
+        """
+        output = entry.get('output')
+        if not output:
+            # Compile databases written by Ninja before 1.10 have no output field
+            args = self.get_compile_args(entry)
+            for i, arg in enumerate(args):
+                if arg == '-o' and i + 1 < len(args):
+                    output = args[i + 1]
+                elif arg.startswith(('/Fo', '-Fo')):
+                    output = arg[3:]
+        if not output:
+            return None
+        return os.path.relpath(os.path.join(entry['directory'], output), self.build_dir)
+
+    def get_object_output(self, target, source):
+        """
+        Get the object file a target compiles source to, relative to the build dir, or None.
+        """
+        entries = self.get_compile_commands_index().get(os.path.normpath(os.path.join(self.source_dir, source)), [])
+        outputs = [self.get_compile_output(entry) for entry in entries]
+        for output in outputs:
+            if output and (self.get_output_target(output) or {}).get('id') == target['id']:
+                return output
+        return next((output for output in outputs if output), None)
+
     def get_compiler(self, target=None):
         if not target:
             target = self.get_targets()[0]
@@ -203,11 +448,12 @@ class Meson:
             lang = 'c'
 
         if lang not in self.c_default_inc_dirs:
-            output = subprocess.Popen([compiler, '-x' + lang, '-E', '-v', '-'],
-                                      stdin=subprocess.DEVNULL,
-                                      stdout=subprocess.DEVNULL,
-                                      stderr=subprocess.PIPE)
-            stderr = output.stderr.read().decode()
+            with self.tracer.span('probe ' + compiler, 'compiler', lang=lang):
+                output = subprocess.Popen([compiler, '-x' + lang, '-E', '-v', '-'],
+                                          stdin=subprocess.DEVNULL,
+                                          stdout=subprocess.DEVNULL,
+                                          stderr=subprocess.PIPE)
+                stderr = output.stderr.read().decode()
             start = False
             paths = []
             for line in stderr.split('\n'):
@@ -227,15 +473,163 @@ class Meson:
         return os.path.join(self.build_dir, self.get_target_filename(target))
 
     def get_target_filename(self, target):
-        if self.get_version()[1] >= 50:
+        # Meson 0.50.0 and later list all outputs of a target
+        if isinstance(target['filename'], list):
             return target['filename'][0]
         else:
             return target['filename']
 
+    def get_target_dir(self, target):
+        return os.path.dirname(os.path.relpath(self.get_output(target), self.build_dir))
+
+    def get_output_targets(self):
+        """
+        Map target outputs and private object dirs to targets.
+        """
+        if self.c_output_targets is None:
+            self.c_output_targets = {}
+            for target in self.get_targets():
+                for output in self.get_target_outputs(target):
+                    self.c_output_targets[output] = target
+                    # Meson 0.55.0 and later keep objects in <output>.p
+                    self.c_output_targets[output + '.p'] = target
+                # Older Meson versions keep objects in <dir>/<id>
+                self.c_output_targets[os.path.join(self.get_target_dir(target), target['id'])] = target
+        return self.c_output_targets
+
+    def get_output_target(self, output):
+        """
+        Get the target a build output belongs to, or None.
+        """
+        output_targets = self.get_output_targets()
+        path = os.path.normpath(output)
+        while path:
+            if path in output_targets:
+                return output_targets[path]
+            path = os.path.dirname(path)
+        return None
+
+    def get_header_index(self):
+        """
+        Map headers in the source dir to the ids of the targets including them,
+        as recorded by the build backend the last time their objects were built.
+        """
+        return self.get_header_indexes()[0]
+
+    def get_target_headers(self, target):
+        """
+        Get the headers included by the sources of a target as absolute paths.
+        """
+        return self.get_header_indexes()[1].get(target['id'], [])
+
+    def get_header_indexes(self):
+        """
+        Get the header to targets index and the reverse target to headers index.
+        They are rebuilt when the backend records new dependencies.
+        """
+        deps = self.backend.get_deps()
+        if self.c_header_index and self.c_header_index[0] is deps:
+            return self.c_header_index[1:]
+
+        if not deps or not self.source_dir:
+            return {}, {}
+
+        sources = set()
+        for target in self.get_targets():
+            for target_file in self.get_target_files(target):
+                sources.add(os.path.normpath(os.path.join(self.source_dir, target_file)))
+
+        # Most headers are included by many objects, so each path is only resolved once
+        headers = {}
+        source_prefix = os.path.join(self.source_dir, '')
+        build_prefix = os.path.join(self.build_dir, '')
+        for paths in deps.values():
+            for path in paths:
+                if path not in headers:
+                    header = os.path.normpath(os.path.join(self.build_dir, path))
+                    # System headers, generated headers and sources are not headers of a target
+                    if header in sources or not header.startswith(source_prefix) or header.startswith(build_prefix):
+                        header = None
+                    headers[path] = header
+
+        header_index = {}
+        for output, paths in deps.items():
+            target = self.get_output_target(output)
+            if not target:
+                continue
+            for path in paths:
+                if headers[path]:
+                    header_index.setdefault(headers[path], set()).add(target['id'])
+
+        target_headers = {}
+        for header, targets in header_index.items():
+            for target in targets:
+                target_headers.setdefault(target, []).append(header)
+        for headers in target_headers.values():
+            headers.sort()
+
+        self.c_header_index = (deps, header_index, target_headers)
+        return header_index, target_headers
+
     def get_options(self):
         meson_options = []
 
         if self.cross_file:
             meson_options += ['--cross-file', self.cross_file]
 
+        if self.build_type:
+            meson_options += ['--buildtype', self.build_type]
+
         return meson_options
+
+    def set_option(self, name, value):
+        self.options[name] = value
+
+    def get_requested_options(self):
+        options = dict(self.options)
+        if self.build_type:
+            options['buildtype'] = self.build_type
+        return options
+
+    def get_changed_options(self):
+        build_options = {option['name']: option for option in self.get_build_options()}
+
+        changed_options = {}
+        for name, value in self.get_requested_options().items():
+            if name not in build_options:
+                self.log('(unknown option) "%s"', name)
+                continue
+            value = self.convert_option(build_options[name], value)
+            if value != build_options[name]['value']:
+                changed_options[name] = value
+        return changed_options
+
+    def convert_option(self, option, value):
+        """
+        Convert a CMake cache value to the type of a Meson build option.
+        """
+        if not isinstance(value, str):
+            return value
+        if option['type'] == 'boolean':
+            return value.upper() in ('1', 'ON', 'YES', 'TRUE', 'Y')
+        if option['type'] == 'integer':
+            try:
+                return int(value)
+            except ValueError:
+                raise RuntimeError('CMake Error: Invalid value for integer option MESON_%s: %s'
+                                   % (option['name'], value))
+        if option['type'] == 'array':
+            return [item for item in value.split(';') if item]
+        return value
+
+    def format_option(self, value):
+        if isinstance(value, bool):
+            return 'true' if value else 'false'
+        if isinstance(value, list):
+            return repr(value)
+        return str(value)
+
+    def get_cross_files(self):
+        if not self.cross_file:
+            return []
+        return [os.path.abspath(self.cross_file)]
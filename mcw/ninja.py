@@ -1,7 +1,17 @@
 import os
+import struct
+import difflib
 import subprocess
 
-from .util import find_executables
+from .util import find_executables, load_pickle, save_pickle
+
+# Targets Ninja knows without asking Meson
+PSEUDO_TARGETS = ('all', 'clean', 'install', 'test', 'benchmark', 'reconfigure')
+
+DEPS_SIGNATURE = b'# ninjadeps\n'
+# Version 3 stores 32-bit mtimes in deps records, version 4 stores 64-bit mtimes
+DEPS_MTIME_SIZES = {3: 4, 4: 8}
+DEPS_RECORD_FLAG = 0x80000000
 
 
 class NinjaBackend:
@@ -13,18 +23,27 @@ class NinjaBackend:
         self.meson = meson
         self.path = find_executables(['ninja-build', 'ninja'])
 
+        # Cache
+        self.c_target_index = None
+        self.c_deps = None
+
+    def clear_cache(self):
+        self.c_target_index = None
+        self.c_deps = None
+
     def call(self, args, show=False):
-        child = subprocess.Popen([self.path] + args, stdout=subprocess.PIPE)
-        fulloutput = b''
-        while True:
-            output = child.stdout.readline()
-            if output == b'' and child.poll() is not None:
-                break
-            if output:
-                if show:
-                    print(output.decode("utf-8"), end='')
-                fulloutput += output
-        fulloutput = fulloutput.decode("utf-8")
+        with self.meson.tracer.span('ninja', 'ninja', args=args):
+            child = subprocess.Popen([self.path] + args, stdout=subprocess.PIPE)
+            fulloutput = b''
+            while True:
+                output = child.stdout.readline()
+                if output == b'' and child.poll() is not None:
+                    break
+                if output:
+                    if show:
+                        print(output.decode("utf-8"), end='')
+                    fulloutput += output
+            fulloutput = fulloutput.decode("utf-8")
         if child.poll() != 0:
             raise RuntimeError(fulloutput)
         return fulloutput
@@ -38,12 +57,178 @@ class NinjaBackend:
     def reconfigure(self):
         self.call(['-C', self.meson.build_dir, 'reconfigure'], True)
 
-    def build(self, target):
-        self.call(['-C', self.meson.build_dir, self.get_target(target)], True)
+    def build(self, targets, jobs=None, clean_first=False, args=()):
+        # Clean separately as Ninja does not order targets of one invocation
+        if clean_first or 'clean' in targets:
+            self.call(['-C', self.meson.build_dir, 'clean'], True)
+            targets = [target for target in targets if target != 'clean']
+            if not targets:
+                return
+
+        ninja_args = ['-C', self.meson.build_dir]
+        if jobs:
+            ninja_args += ['-j', str(jobs)]
+        ninja_targets = []
+        for target in targets:
+            ninja_targets += self.get_target(target)
+        self.call(ninja_args + list(args) + ninja_targets, True)
 
     def get_target(self, target_name):
-        target = next((t for t in self.meson.get_targets() if t['name'] == target_name), None)
-        if target:
-            return target['filename']
+        """
+        Get the Ninja targets of a Meson target name, id or output.
+        """
+        if target_name in PSEUDO_TARGETS:
+            return [target_name]
+
+        target_index = self.get_target_index()
+        if target_name in target_index:
+            return target_index[target_name]
+
+        ids = [target['id'] for target in self.meson.get_targets() if target['name'] == target_name]
+        if ids:
+            raise RuntimeError('Ambiguous target: "%s"\nUse one of the target ids: %s'
+                               % (target_name, ', '.join('"%s"' % id for id in ids)))
+
+        msg = 'Unknown target: "%s"' % target_name
+        suggestions = difflib.get_close_matches(target_name, target_index.keys())
+        if suggestions:
+            msg += '\nDid you mean: %s' % ', '.join('"%s"' % suggestion for suggestion in suggestions)
+        raise RuntimeError(msg)
+
+    def get_log_entries(self):
+        """
+        Get the entries of .ninja_log as {output: (start, end, cmd_hash, build)}.
+        Only lines appended since the last call are parsed, the parser state is kept in meson-private.
+        """
+        log_file = os.path.join(self.meson.build_dir, '.ninja_log')
+        state_file = os.path.join(self.meson.build_dir, 'meson-private', 'mcw-ninja-log.pk1')
+        if not os.path.exists(log_file):
+            return {}
+
+        # Ninja replaces the log when recompacting it
+        stat = os.stat(log_file)
+        state = load_pickle(state_file)
+        if not state or state['inode'] != stat.st_ino or state['offset'] > stat.st_size:
+            state = {'inode': stat.st_ino, 'offset': 0, 'build': 0, 'last_end': 0, 'entries': {}}
+
+        with open(log_file, 'rb') as file:
+            file.seek(state['offset'])
+            data = file.read()
+        # Leave the incomplete last line of a running build for the next call
+        data = data[:data.rfind(b'\n') + 1]
+        state['offset'] += len(data)
+
+        for line in data.decode('utf-8', 'replace').splitlines():
+            fields = line.split('\t')
+            if line.startswith('#') or len(fields) < 5:
+                continue
+            start, end = int(fields[0]), int(fields[1])
+            # Times restart from zero with every Ninja invocation
+            if end < state['last_end']:
+                state['build'] += 1
+            state['last_end'] = end
+            state['entries'][fields[3]] = (start, end, fields[4], state['build'])
+
+        if os.path.isdir(os.path.dirname(state_file)):
+            save_pickle(state_file, state)
+        return state['entries']
+
+    def get_deps(self):
+        """
+        Get the dependencies in .ninja_deps as {output: [paths]}, paths are relative to the build dir or absolute.
+        Only records appended since the last call are parsed, the parser state is kept in meson-private.
+        """
+        deps_file = os.path.join(self.meson.build_dir, '.ninja_deps')
+        state_file = os.path.join(self.meson.build_dir, 'meson-private', 'mcw-ninja-deps.pk1')
+        if not os.path.exists(deps_file):
+            return {}
+
+        stat = os.stat(deps_file)
+        if self.c_deps and self.c_deps[0] == (stat.st_ino, stat.st_size):
+            return self.c_deps[1]
+
+        # Ninja replaces the file when recompacting it
+        state = load_pickle(state_file)
+        if not state or state['inode'] != stat.st_ino or state['offset'] > stat.st_size:
+            state = {'inode': stat.st_ino, 'offset': 0, 'version': None, 'paths': [], 'deps': {}}
+
+        with open(deps_file, 'rb') as file:
+            file.seek(state['offset'])
+            data = file.read()
+        if state['offset'] == 0:
+            if not data.startswith(DEPS_SIGNATURE) or len(data) < len(DEPS_SIGNATURE) + 4:
+                return {}
+            state['version'] = struct.unpack_from('=i', data, len(DEPS_SIGNATURE))[0]
+            state['offset'] = len(DEPS_SIGNATURE) + 4
+            data = data[state['offset']:]
+        if state['version'] not in DEPS_MTIME_SIZES:
+            return {}
+
+        offset = self.parse_deps_records(state, data)
+        state['offset'] += offset
+
+        if os.path.isdir(os.path.dirname(state_file)):
+            save_pickle(state_file, state)
+
+        paths = state['paths']
+        deps = {paths[output]: [paths[dep] for dep in dep_ids] for output, dep_ids in state['deps'].items()}
+        # Keyed like the check above, a trailing incomplete record leaves the offset short of the size
+        self.c_deps = ((stat.st_ino, stat.st_size), deps)
+        return deps
+
+    def parse_deps_records(self, state, data):
+        """
+        Parse .ninja_deps records into the parser state, returns the offset after the last complete record.
+        Each record starts with its size, the high bit of the size marks dependency records.
+        Path records hold a NUL padded path and the inverted id of the path as checksum,
+        dependency records hold the id of an output, its mtime and the ids of its dependencies.
+        """
+        deps_start = 4 + DEPS_MTIME_SIZES[state['version']]
+        offset = 0
+        while offset + 4 <= len(data):
+            size = struct.unpack_from('=I', data, offset)[0]
+            is_deps = size & DEPS_RECORD_FLAG
+            size &= ~DEPS_RECORD_FLAG
+            # Leave the incomplete last record of a running build for the next call
+            if offset + 4 + size > len(data) or size < 4:
+                break
+            start = offset + 4
+
+            if is_deps:
+                output = struct.unpack_from('=i', data, start)[0]
+                count = (size - deps_start) // 4
+                state['deps'][output] = struct.unpack_from('=%di' % count, data, start + deps_start)
+            else:
+                checksum = struct.unpack_from('=I', data, start + size - 4)[0]
+                # Ninja stops reading at a bad checksum and truncates the file on its next run
+                if checksum != ~len(state['paths']) & 0xffffffff:
+                    break
+                state['paths'].append(data[start:start + size - 4].rstrip(b'\0').decode('utf-8', 'surrogateescape'))
+            offset = start + size
+        return offset
+
+    def get_target_index(self):
+        if self.c_target_index is None:
+            self.c_target_index = self.meson.get_cached('target-index', self.build_target_index)
+        return self.c_target_index
+
+    def build_target_index(self):
+        target_index = {}
+
+        # Every output Ninja knows about is a target of its own
+        output = self.call(['-C', self.meson.build_dir, '-t', 'targets', 'all'])
+        for line in output.splitlines():
+            ninja_target = line.rpartition(': ')[0]
+            if ninja_target:
+                target_index[ninja_target] = [ninja_target]
 
-        return target_name
+        names = {}
+        for target in self.meson.introspect('targets'):
+            outputs = self.meson.get_target_outputs(target)
+            target_index[target['id']] = outputs
+            names.setdefault(target['name'], []).append(outputs)
+        # Target names are only unique per directory, so only unique names refer to a target
+        for name, outputs in names.items():
+            if len(outputs) == 1:
+                target_index.setdefault(name, outputs[0])
+        return target_index
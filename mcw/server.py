@@ -1,6 +1,11 @@
 import os
 import json
 import socket
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from .ctest import get_test_properties
 
 SERVER_HEADER = b'\n[== "CMake Server" ==[\n'
 SERVER_FOOTER = b'\n]== "CMake Server" ==]\n'
@@ -18,14 +23,16 @@ class ServerWrapper:
         self.pipe = None
         self.connected = False
         self.requests = []
-        self.protocol_version = (1, 1)
+        self.protocol_version = (1, 2)
         self.cookies = {}
+        # Log records are forwarded from another thread
+        self.write_lock = threading.Lock()
 
-    def log(self, msg):
+    def log(self, msg, *args, level=logging.INFO):
         if isinstance(msg, Exception):
-            self.logger.info(msg, exc_info=msg)
+            self.logger.error(msg, exc_info=msg)
         else:
-            self.logger.info(msg)
+            self.logger.log(level, msg, *args)
 
     def run(self, args):
         try:
@@ -33,7 +40,7 @@ class ServerWrapper:
             self.connected = True
             self.handle_hello()
             self.handle_handshake()
-            self.log('running on "%s"' % self.pipe)
+            self.log('running on "%s"', self.pipe)
             while 1:
                 request = self.recv()
                 if not request:
@@ -41,14 +48,17 @@ class ServerWrapper:
                     break
 
                 if not hasattr(self, 'handle_' + request['type'].lower()):
-                    self.log('unhandled request: "%s"' % request)
+                    self.log('unhandled request: "%s"', request)
                     break
-                getattr(self, 'handle_' + request['type'].lower())(request)
+                with self.cmake.tracer.span(request['type'], 'server'):
+                    getattr(self, 'handle_' + request['type'].lower())(request)
         except BrokenPipeError:
             self.connected = False
             self.log('lost connection to client')
         finally:
             self.log('closing connection')
+            for handler in self.logger.handlers:
+                handler.flush()
             self.cleanup()
 
     def connect(self, args):
@@ -81,12 +91,14 @@ class ServerWrapper:
             if response['inReplyTo'] in self.cookies:
                 response['cookie'] = self.cookies[response['inReplyTo']]
             if log:
-                self.log('%s (%s) "%s"' % (response['inReplyTo'], response['type'], response))
+                self.log('%s (%s) "%s"', response['inReplyTo'], response['type'], response, level=logging.DEBUG)
         elif log:
-            self.log(response)
+            self.log('%s', response)
 
-        response = SERVER_HEADER + json.dumps(response).encode('utf-8') + SERVER_FOOTER
-        self.write(response)
+        with self.cmake.tracer.span('encode ' + response['type'], 'server'):
+            response = SERVER_HEADER + json.dumps(response).encode('utf-8') + SERVER_FOOTER
+        with self.write_lock:
+            self.write(response)
 
     def parse_recv(self, data):
         requests = data.split(SERVER_FOOTER + SERVER_HEADER)
@@ -97,7 +109,7 @@ class ServerWrapper:
             request = json.loads(request)
             if 'cookie' in request:
                 self.cookies[request['type']] = request['cookie']
-            self.log('received (%s) "%s"' % (request['type'], request))
+            self.log('received (%s) "%s"', request['type'], request)
             self.requests.append(request)
 
     def send_reply(self, reply_to, log=True):
@@ -158,6 +170,11 @@ class ServerWrapper:
             if entry.startswith('-D'):
                 self.cmake.parse_cache_entry(entry)
 
+        # Write changed Meson options back with a single 'meson configure' per configuration
+        self.cmake.setup_configurations()
+        self.cmake.clear_meson_options()
+        self.cmake.save_cache_entries()
+
         self.send_progress('configure', 1000, msg='Configuring')
         self.send_message('Configuring done', 'configure')
         self.send_reply('configure')
@@ -216,31 +233,70 @@ class ServerWrapper:
         }
         self.send(response)
 
+    def get_build_files(self):
+        """
+        Sort the files Meson regenerates the build dir for into CMake build file groups.
+        Files of subprojects are temporary like files CMake generates, files of the Meson install are CMake files.
+        """
+        source_prefix = os.path.join(self.cmake.source_dir, '')
+        build_prefix = os.path.join(self.meson.build_dir, '')
+        subproject_prefixes = tuple(os.path.join(self.cmake.source_dir, self.meson.get_subproject_dir(subproject['name']), '')
+                                    for subproject in self.meson.get_subprojects())
+        install_dir = self.meson.get_install_dir()
+
+        files = [os.path.join(self.cmake.source_dir, file) for file in self.meson.get_buildsystem_files()]
+        files += self.meson.load_setup_state().get('cross_files', [])
+        # IDEs open the project through the empty CMakeLists.txt
+        cmake_file = os.path.join(self.cmake.source_dir, 'CMakeLists.txt')
+        if os.path.exists(cmake_file):
+            files.insert(0, cmake_file)
+
+        # Grouped by (isCMake, isTemporary)
+        groups = {}
+        for file in files:
+            file = os.path.normpath(file)
+            if file.startswith(build_prefix) or file.startswith(subproject_prefixes):
+                group = (False, True)
+            elif not file.startswith(source_prefix) and install_dir and file.startswith(os.path.join(install_dir, '')):
+                group = (True, False)
+            else:
+                group = (False, False)
+            source = os.path.relpath(file, self.cmake.source_dir) if file.startswith(source_prefix) else file
+            groups.setdefault(group, []).append(source)
+
+        return [{'isCMake': is_cmake, 'isTemporary': is_temporary, 'sources': sources}
+                for (is_cmake, is_temporary), sources in sorted(groups.items())]
+
     def handle_cmakeinputs(self, request):
         response = {
             'inReplyTo': 'cmakeInputs',
             'type': 'reply',
-            'buildFiles': [
-                {
-                    'sources': 'CMakeLists.txt',
-                    'isCMake': False,
-                    'isTemporary': False
-                }
-            ],
+            'buildFiles': self.meson.get_cached('cmake-inputs', self.get_build_files),
             'cmakeRootDirectory': '/usr/share/cmake',
             'sourceDirectory': self.cmake.source_dir,
         }
         self.send(response)
 
     def get_cache_entries(self):
+        meson_entries = self.cmake.get_meson_cache_entries()
+
         cache_entries = []
         for key, val in self.cmake.cache_entries.items():
+            if key in meson_entries:
+                continue
             cache_entries.append({
                 'key': key.upper(),
                 'value': val[0],
                 'type': val[1],
                 'properties': {}
             })
+        for key, val in meson_entries.items():
+            cache_entries.append({
+                'key': key,
+                'value': val[0],
+                'type': val[1],
+                'properties': val[2]
+            })
         return cache_entries
 
     def handle_cache(self, request):
@@ -251,39 +307,57 @@ class ServerWrapper:
         }
         self.send(response)
 
-    def get_include_paths(self, target):
+    def get_include_paths(self, target, meson):
         include_paths = []
-        for include_path in self.meson.get_include_directories(target, False):
+        for include_path in meson.get_include_directories(target, False):
             include_paths.append({'path': include_path, 'isSystem': False})
-        for include_path in self.meson.get_default_include_directories(target):
+        for include_path in meson.get_default_include_directories(target):
             include_paths.append({'path': include_path, 'isSystem': True})
         return include_paths
 
-    def get_file_groups(self, target):
+    def get_file_groups(self, target, meson):
         sources = []
-        for target_file in self.meson.get_target_files(target):
-            sources.append(os.path.relpath(target_file, os.path.dirname(target['filename'])))
+        target_dir = os.path.join(self.cmake.source_dir, meson.get_target_dir(target))
+        for target_file in meson.get_target_files(target):
+            sources.append(os.path.relpath(os.path.join(self.cmake.source_dir, target_file), target_dir))
         file_group = {
             'isGenerated': False,
             'sources': sources,
-            'compileFlags': ' '.join(self.meson.get_flags(target)),
-            'defines': [define[2:] for define in self.meson.get_defines(target)],
-            'includePath': self.get_include_paths(target),
-            'language': 'CXX' if self.meson.get_compiler(target).endswith('++') else 'C'
+            'compileFlags': ' '.join(meson.get_flags(target)),
+            'defines': [define[2:] for define in meson.get_defines(target)],
+            'includePath': self.get_include_paths(target, meson),
+            'language': 'CXX' if meson.get_compiler(target).endswith('++') else 'C'
         }
 
+        file_groups = [file_group]
+
+        # Headers have a file group without compile settings, as in CMake
+        headers = meson.get_target_headers(target)
+        if headers:
+            file_groups.append({
+                'isGenerated': False,
+                'sources': [os.path.relpath(header, target_dir) for header in headers]
+            })
+
         meson_group = {
             'isGenerated': False,
             'sources': ['meson.build']
         }
+        file_groups.append(meson_group)
 
-        return [file_group, meson_group]
+        return file_groups
 
-    def get_project(self):
+    def get_project(self, meson, subproject, targets):
+        if subproject:
+            project_dir = meson.get_subproject_dir(subproject['name'])
+            name = subproject['name']
+        else:
+            project_dir = ''
+            name = meson.get_project_name()
         project = {
-            'name': self.meson.get_project_name(),
-            'buildDirectory': self.cmake.build_dir,
-            'sourceDirectory': self.cmake.source_dir,
+            'name': name,
+            'buildDirectory': os.path.normpath(os.path.join(meson.build_dir, project_dir)),
+            'sourceDirectory': os.path.normpath(os.path.join(self.cmake.source_dir, project_dir)),
             'targets': []
         }
 
@@ -295,32 +369,106 @@ class ServerWrapper:
             'run': 'UTILITY'
         }
 
-        for mtarget in self.meson.get_targets():
+        for mtarget in targets:
             target = {}
             target['name'] = mtarget['name']
             target['fullName'] = mtarget['name']
             target['artifacts'] = [
-                os.path.join(self.meson.build_dir, mtarget['filename'])
+                meson.get_output(mtarget)
             ]
-            target['buildDirectory'] = os.path.join(self.cmake.build_dir, os.path.dirname(mtarget['filename']))
-            target['sourceDirectory'] = os.path.join(self.cmake.source_dir, os.path.dirname(mtarget['filename']))
+            target['buildDirectory'] = os.path.join(meson.build_dir, meson.get_target_dir(mtarget))
+            target['sourceDirectory'] = os.path.join(self.cmake.source_dir, meson.get_target_dir(mtarget))
             target['type'] = type_mapper[mtarget['type']]
-            target['fileGroups'] = self.get_file_groups(mtarget)
+            # Vendored code is still built, but IDEs have nothing to index
+            if subproject and self.cmake.skip_subproject_files:
+                target['fileGroups'] = []
+            else:
+                target['fileGroups'] = self.get_file_groups(mtarget, meson)
             project['targets'].append(target)
         return project
 
+    def get_projects(self, meson):
+        """
+        Get a project for the root project and one for each Meson subproject, so IDEs can load them separately.
+        """
+        project_targets = {}
+        for target in meson.get_targets():
+            project_targets.setdefault(target.get('subproject'), []).append(target)
+
+        projects = [self.get_project(meson, None, project_targets.get(None, []))]
+        for subproject in meson.get_subprojects():
+            projects.append(self.get_project(meson, subproject, project_targets.get(subproject['name'], [])))
+        return projects
+
+    def get_configuration(self, configuration):
+        name, meson = configuration
+        return {
+            'name': name,
+            'projects': self.get_projects(meson)
+        }
+
     def handle_codemodel(self, request):
+        # Introspect the build dirs of all configurations concurrently
+        configurations = self.cmake.get_configurations()
+        with ThreadPoolExecutor(max_workers=len(configurations)) as executor:
+            configurations = list(executor.map(self.get_configuration, configurations))
+
         response = {
             'inReplyTo': 'codemodel',
             'type': 'reply',
-            'configurations': [
-                {
-                    'name': self.cmake.build_type,
-                    'projects': [
-                        self.get_project(),
-                    ]
-                }
-            ],
+            'configurations': configurations,
+        }
+        self.send(response)
+
+    def get_ctest_info(self, test, meson):
+        properties = []
+        for name, value in get_test_properties(test, meson.build_dir):
+            # CMake test properties are strings
+            if isinstance(value, list):
+                value = ';'.join(value)
+            elif isinstance(value, bool):
+                value = 'TRUE' if value else 'FALSE'
+            properties.append({'key': name, 'value': str(value)})
+        return {
+            'ctestName': test['name'],
+            'ctestCommand': ' '.join(test['cmd']),
+            'properties': properties
+        }
+
+    def get_ctest_targets(self, meson):
+        """
+        Get the tests of a build dir attached to the targets whose outputs they run.
+        Other tests are attached to a 'test' target, like the test target CMake generates.
+        """
+        output_targets = meson.get_output_targets()
+        target_tests = {}
+        for test in meson.get_tests():
+            name = 'test'
+            for arg in test['cmd']:
+                if os.path.isabs(arg) and os.path.relpath(arg, meson.build_dir) in output_targets:
+                    name = output_targets[os.path.relpath(arg, meson.build_dir)]['name']
+                    break
+            target_tests.setdefault(name, []).append(self.get_ctest_info(test, meson))
+
+        names = [target['name'] for target in meson.get_targets()] + ['test']
+        return [{'name': name, 'ctestInfo': target_tests.pop(name)} for name in names if name in target_tests]
+
+    def get_ctest_configuration(self, configuration):
+        name, meson = configuration
+        return {
+            'name': name,
+            'projects': [{
+                'name': meson.get_project_name(),
+                'targets': meson.get_cached('ctest-info', lambda: self.get_ctest_targets(meson))
+            }]
+        }
+
+    def handle_ctestinfo(self, request):
+        response = {
+            'inReplyTo': 'ctestInfo',
+            'type': 'reply',
+            'configurations': [self.get_ctest_configuration(configuration)
+                               for configuration in self.cmake.get_configurations()]
         }
         self.send(response)
 
@@ -0,0 +1,55 @@
+import os
+import json
+import time
+import threading
+from contextlib import contextmanager
+
+
+class Tracer:
+    """
+    Class that records timed spans as Chrome trace events.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.events = []
+        self.lock = threading.Lock()
+        self.start = time.perf_counter()
+
+    @contextmanager
+    def span(self, name, category, **args):
+        if not self.enabled:
+            yield
+            return
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            event = {
+                'name': name,
+                'cat': category,
+                'ph': 'X',
+                'ts': (start - self.start) * 1000000,
+                'dur': (end - start) * 1000000,
+                'pid': os.getpid(),
+                'tid': threading.get_ident(),
+                'args': args
+            }
+            with self.lock:
+                self.events.append(event)
+
+    def write(self, trace_file):
+        with open(trace_file, 'w') as file:
+            json.dump({'traceEvents': self.events, 'displayTimeUnit': 'ms'}, file)
+
+    def get_summary(self):
+        """
+        Get the number of spans and total time in seconds per category.
+        """
+        summary = {}
+        for event in self.events:
+            count, duration = summary.get(event['cat'], (0, 0))
+            summary[event['cat']] = (count + 1, duration + event['dur'] / 1000000)
+        return summary
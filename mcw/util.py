@@ -1,5 +1,16 @@
+import os
+import mmap
+import pickle
+import shutil
+import hashlib
+from itertools import zip_longest
 from distutils.spawn import find_executable
 
+# Files are streamed in chunks of this size instead of being read into memory
+CHUNK_SIZE = 1024 * 1024
+# Number of threads for parallel file operations, which mostly wait on I/O
+IO_WORKERS = min(32, (os.cpu_count() or 1) + 4)
+
 
 def debug_connect():
     connected = False
@@ -27,3 +38,231 @@ def find_executables(file_names):
         if res:
             return res
     raise RuntimeError('Executables "%s" not found in path.' % file_names)
+
+
+def write_if_changed(path, content):
+    """
+    Write content to path unless the file already holds exactly that content.
+    Returns True if the file was written.
+    """
+    if os.path.exists(path):
+        with open(path) as file:
+            if file.read() == content:
+                return False
+    with open(path, 'w') as file:
+        file.write(content)
+    return True
+
+
+def load_pickle(path):
+    """
+    Load a pickled value, returns None if it is missing or unreadable.
+    """
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, 'rb') as input:
+            return pickle.load(input)
+    except (pickle.UnpicklingError, EOFError, ValueError):
+        return None
+
+
+def save_pickle(path, value):
+    """
+    Pickle a value, replacing path atomically as several mcw processes may share a build dir.
+    Readers see either the previous or the new pickle, never a half-written one.
+    """
+    tmp_path = '%s.%d' % (path, os.getpid())
+    try:
+        with open(tmp_path, 'wb') as output:
+            pickle.dump(value, output, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+    except BaseException:
+        # Do not leave the temporary file of a failed write behind
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def file_digest(path, algorithm):
+    """
+    Get the hex digest of a file, streaming it through a reused buffer.
+    hashlib releases the GIL for large updates, so files can be hashed in parallel threads.
+    """
+    digest = hashlib.new(algorithm)
+    buffer = bytearray(CHUNK_SIZE)
+    view = memoryview(buffer)
+    with open(path, 'rb', buffering=0) as file:
+        size = file.readinto(buffer)
+        while size:
+            digest.update(view[:size])
+            size = file.readinto(buffer)
+    return digest.hexdigest()
+
+
+def files_equal(path1, path2):
+    """
+    Compare the content of two files, checking the size first and stopping at the first differing chunk.
+    """
+    size = os.path.getsize(path1)
+    if size != os.path.getsize(path2):
+        return False
+    # Empty files cannot be mapped
+    if not size:
+        return True
+    with open(path1, 'rb') as file1, open(path2, 'rb') as file2, \
+            mmap.mmap(file1.fileno(), 0, access=mmap.ACCESS_READ) as map1, \
+            mmap.mmap(file2.fileno(), 0, access=mmap.ACCESS_READ) as map2:
+        for offset in range(0, size, CHUNK_SIZE):
+            if map1[offset:offset + CHUNK_SIZE] != map2[offset:offset + CHUNK_SIZE]:
+                return False
+    return True
+
+
+def text_files_equal(path1, path2):
+    """
+    Compare two text files line by line, ignoring differences in line endings.
+    """
+    with open(path1, 'rb') as file1, open(path2, 'rb') as file2:
+        for line1, line2 in zip_longest(file1, file2):
+            if line1 is None or line2 is None or line1.rstrip(b'\r\n') != line2.rstrip(b'\r\n'):
+                return False
+    return True
+
+
+def _copy_file_range(fd_in, fd_out, size):
+    offset = 0
+    while offset < size:
+        copied = os.copy_file_range(fd_in, fd_out, min(size - offset, 1 << 30), offset, offset)
+        if not copied:
+            break
+        offset += copied
+    return offset
+
+
+def _sendfile(fd_in, fd_out, size):
+    offset = 0
+    while offset < size:
+        sent = os.sendfile(fd_out, fd_in, offset, min(size - offset, 1 << 30))
+        if not sent:
+            break
+        offset += sent
+    return offset
+
+
+def copy_file(src, dst):
+    """
+    Copy the content and mode of a file.
+    The data is copied in the kernel with copy_file_range or sendfile where available.
+    Like in CMake, copying a file onto itself does nothing.
+    """
+    # Opening dst for writing would truncate src
+    if os.path.exists(dst) and os.path.samefile(src, dst):
+        return
+
+    kernel_copies = []
+    if hasattr(os, 'copy_file_range'):
+        kernel_copies.append(_copy_file_range)
+    if hasattr(os, 'sendfile'):
+        kernel_copies.append(_sendfile)
+
+    with open(src, 'rb') as file_in, open(dst, 'wb') as file_out:
+        fd_in = file_in.fileno()
+        fd_out = file_out.fileno()
+        size = os.fstat(fd_in).st_size
+        # Files like those in /proc report a size of 0, so only a read loop copies them
+        for kernel_copy in kernel_copies if size else []:
+            try:
+                if kernel_copy(fd_in, fd_out, size) == size:
+                    break
+            except OSError:
+                pass
+            # Unsupported for these files, start over with the next method
+            os.ftruncate(fd_out, 0)
+            os.lseek(fd_out, 0, os.SEEK_SET)
+        else:
+            shutil.copyfileobj(file_in, file_out, CHUNK_SIZE)
+    shutil.copymode(src, dst)
+
+
+def copy_file_if_different(src, dst):
+    """
+    Copy a file unless dst already has the same content, so its mtime does not trigger rebuilds.
+    Returns True if the file was copied.
+    """
+    if os.path.isfile(dst) and files_equal(src, dst):
+        return False
+    copy_file(src, dst)
+    return True
+
+
+def copy_tree(src, dst, executor, if_different=False):
+    """
+    Copy the content of directory src into dst, merging with existing content.
+    Directories are created up front and files are copied on executor, symbolic links are copied as links.
+    Returns the futures of the file copies.
+    """
+    dirs = [dst]
+    files = []
+    links = []
+    walk = [(src, dst)]
+    while walk:
+        src_dir, dst_dir = walk.pop()
+        for entry in os.scandir(src_dir):
+            target = os.path.join(dst_dir, entry.name)
+            if entry.is_symlink():
+                links.append((os.readlink(entry.path), target))
+            elif entry.is_dir():
+                dirs.append(target)
+                walk.append((entry.path, target))
+            else:
+                files.append((entry.path, target))
+
+    # Parents are always listed before their children
+    for dir in dirs:
+        os.makedirs(dir, exist_ok=True)
+    for link, target in links:
+        if os.path.lexists(target):
+            os.remove(target)
+        os.symlink(link, target)
+
+    copy = copy_file_if_different if if_different else copy_file
+    return [executor.submit(copy, file, target) for file, target in files]
+
+
+def _remove_file(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def remove_tree(path, executor):
+    """
+    Remove a directory tree, unlinking files on executor while the tree is still being scanned.
+    Paths that are already gone count as removed.
+    """
+    dirs = []
+    futures = []
+    walk = [path]
+    while walk:
+        dir = walk.pop()
+        try:
+            entries = list(os.scandir(dir))
+        except FileNotFoundError:
+            continue
+        dirs.append(dir)
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                walk.append(entry.path)
+            else:
+                futures.append(executor.submit(_remove_file, entry.path))
+
+    for future in futures:
+        future.result()
+    # Directories are listed after their parents, so children are removed first
+    for dir in reversed(dirs):
+        try:
+            os.rmdir(dir)
+        except FileNotFoundError:
+            pass
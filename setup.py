@@ -8,7 +8,8 @@ setup(
     author_email='noverby@prozum.dk',
     url='http://github.com/prozum/meson-cmake-wrapper',
     packages=['mcw'],
-    entry_points={'console_scripts': ['meson-cmake-wrapper=mcw.main:main', 'mcw=mcw.main:main']},
+    entry_points={'console_scripts': ['meson-cmake-wrapper=mcw.main:main', 'mcw=mcw.main:main',
+                                        'mcw-ctest=mcw.main:ctest_main']},
     license='MIT license',
     python_requires='>=3.5',
     long_description=open('README.md').read(),
@@ -0,0 +1,944 @@
+#!/usr/bin/env python3
+"""
+Regression checks for meson-cmake-wrapper, run with 'python3 -m unittest discover test' or pytest.
+Checks that need Meson and Ninja are skipped when they are not installed.
+"""
+import os
+import sys
+import json
+import socket
+import time
+import struct
+import hashlib
+import shutil
+import tempfile
+import unittest
+import subprocess
+import xml.etree.ElementTree as ETree
+
+TEST_DIR = os.path.dirname(os.path.abspath(__file__))
+MCW = [sys.executable, os.path.join(TEST_DIR, '..', 'mcw.py')]
+CTEST = [sys.executable, '-c', 'import sys; sys.path.insert(0, sys.argv.pop(1)); import mcw.main; mcw.main.ctest_main()',
+         os.path.join(TEST_DIR, '..')]
+HAS_NINJA = bool(shutil.which('ninja') or shutil.which('ninja-build'))
+HAS_MESON = bool(shutil.which('meson') and HAS_NINJA)
+
+sys.path.insert(0, os.path.join(TEST_DIR, '..'))
+
+
+def run_mcw(args, cwd):
+    return subprocess.run(MCW + args, cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                          universal_newlines=True)
+
+
+def run_ctest(args, cwd):
+    return subprocess.run(CTEST + args, cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                          universal_newlines=True)
+
+
+def can_import_meson():
+    return subprocess.run([sys.executable, '-c', 'import mesonbuild'], stdout=subprocess.DEVNULL,
+                          stderr=subprocess.DEVNULL).returncode == 0
+
+
+def write_file(path, content):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as file:
+        file.write(content)
+
+
+def read_file(path):
+    with open(path) as file:
+        return file.read()
+
+
+class TempDirTestCase(unittest.TestCase):
+    """
+    Class that gives each test a temporary working directory.
+    """
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix='mcw-test-')
+        self.addCleanup(shutil.rmtree, self.dir)
+
+    def path(self, *parts):
+        return os.path.join(self.dir, *parts)
+
+
+@unittest.skipUnless(HAS_MESON, 'Meson and Ninja are required')
+class BuildDirTestCase(TempDirTestCase):
+    """
+    Class that gives each test a build dir generated from test/simple.
+    """
+
+    def setUp(self):
+        super().setUp()
+        result = run_mcw(['-G', 'Ninja', os.path.join(TEST_DIR, 'simple')], self.dir)
+        self.assertEqual(result.returncode, 0, result.stdout)
+
+    def build(self):
+        result = run_mcw(['--build', '.'], self.dir)
+        self.assertEqual(result.returncode, 0, result.stdout)
+        return result
+
+    def load_cache(self):
+        from mcw.util import load_pickle
+        return load_pickle(self.path('cmake-cache.pk1'))
+
+
+class CopyOntoSelfTest(TempDirTestCase):
+    """
+    Class that checks copying files onto themselves leaves them intact, as in CMake.
+    """
+
+    def setUp(self):
+        super().setUp()
+        write_file(self.path('a.txt'), 'content\n')
+        write_file(self.path('d', 'sub', 'b.txt'), 'nested\n')
+
+    def check_copy(self, args):
+        result = run_mcw(['-E'] + args, self.dir)
+        self.assertEqual(result.returncode, 0, result.stdout)
+        self.assertEqual(read_file(self.path('a.txt')), 'content\n')
+        self.assertEqual(read_file(self.path('d', 'sub', 'b.txt')), 'nested\n')
+
+    def test_copy_into_own_dir(self):
+        self.check_copy(['copy', 'a.txt', '.'])
+
+    def test_copy_onto_self(self):
+        self.check_copy(['copy', 'a.txt', 'a.txt'])
+
+    def test_copy_if_different_onto_self(self):
+        self.check_copy(['copy_if_different', 'a.txt', 'a.txt'])
+
+    def test_copy_directory_onto_self(self):
+        self.check_copy(['copy_directory', 'd', 'd'])
+
+    def test_copy_directory_if_different_onto_self(self):
+        self.check_copy(['copy_directory_if_different', 'd', 'd'])
+
+
+@unittest.skipUnless(HAS_MESON, 'Meson and Ninja are required')
+class ConfigurationsTest(TempDirTestCase):
+    """
+    Class that checks multi-configuration build dirs set up by CMAKE_CONFIGURATION_TYPES.
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.build_dir = self.path('build')
+        os.mkdir(self.build_dir)
+
+    def generate(self, *args):
+        result = run_mcw(['-G', 'Ninja'] + list(args) + [os.path.join(TEST_DIR, 'simple')], self.build_dir)
+        self.assertEqual(result.returncode, 0, result.stdout)
+
+    def get_build_type(self, build_dir):
+        with open(os.path.join(build_dir, 'meson-info', 'intro-buildoptions.json')) as file:
+            return {option['name']: option['value'] for option in json.load(file)}['buildtype']
+
+    def test_build_config_uses_sibling_dir(self):
+        self.generate('-DCMAKE_CONFIGURATION_TYPES=Debug;Release', '-DCMAKE_BUILD_TYPE=Debug')
+        cache = read_file(os.path.join(self.build_dir, 'CMakeCache.txt'))
+
+        result = run_mcw(['--build', '.', '--config', 'Release'], self.build_dir)
+        self.assertEqual(result.returncode, 0, result.stdout)
+
+        self.assertEqual(self.get_build_type(self.build_dir), 'debug')
+        self.assertEqual(self.get_build_type(self.build_dir + '-Release'), 'release')
+        self.assertTrue(os.path.exists(os.path.join(self.build_dir + '-Release', 'simple')))
+        self.assertFalse(os.path.exists(os.path.join(self.build_dir, 'simple')))
+        self.assertEqual(read_file(os.path.join(self.build_dir, 'CMakeCache.txt')), cache)
+
+        # The active configuration is unchanged for the next build
+        result = run_mcw(['--build', '.'], self.build_dir)
+        self.assertEqual(result.returncode, 0, result.stdout)
+        self.assertEqual(self.get_build_type(self.build_dir), 'debug')
+
+    def test_first_configuration_is_active_without_build_type(self):
+        self.generate('-DCMAKE_CONFIGURATION_TYPES=Release;Debug')
+        self.assertEqual(self.get_build_type(self.build_dir), 'release')
+        self.assertEqual(self.get_build_type(self.build_dir + '-Debug'), 'debug')
+        self.assertFalse(os.path.exists(self.build_dir + '-Release'))
+
+    def test_meson_options_apply_to_all_configurations(self):
+        self.generate('-DCMAKE_CONFIGURATION_TYPES=Debug;Release', '-DCMAKE_BUILD_TYPE=Debug')
+        self.generate('-DMESON_warning_level=3')
+        for build_dir in (self.build_dir, self.build_dir + '-Release'):
+            with open(os.path.join(build_dir, 'meson-info', 'intro-buildoptions.json')) as file:
+                self.assertEqual({option['name']: option['value'] for option in json.load(file)}['warning_level'], '3')
+
+    def test_unknown_build_config_fails(self):
+        self.generate('-DCMAKE_CONFIGURATION_TYPES=Debug;Release', '-DCMAKE_BUILD_TYPE=Debug')
+        result = run_mcw(['--build', '.', '--config', 'Bogus'], self.build_dir)
+        self.assertEqual(result.returncode, 1, result.stdout)
+        self.assertFalse(os.path.exists(self.build_dir + '-Bogus'))
+
+
+@unittest.skipUnless(HAS_MESON, 'Meson and Ninja are required')
+class CTestTest(TempDirTestCase):
+    """
+    Class that checks the results of mcw-ctest.
+    """
+
+    def setUp(self):
+        super().setUp()
+        result = run_mcw(['-G', 'Ninja', os.path.join(TEST_DIR, 'tests')], self.dir)
+        self.assertEqual(result.returncode, 0, result.stdout)
+
+    def get_results(self):
+        results = {}
+        with open(self.path('meson-logs', 'testlog-ctest.json')) as file:
+            for line in file:
+                result = json.loads(line)
+                results[result['name']] = result['result']
+        return results
+
+    def test_results(self):
+        result = run_ctest([], self.dir)
+        self.assertEqual(result.returncode, 8, result.stdout + result.stderr)
+
+        results = self.get_results()
+        self.assertEqual(results['pass'], 'OK')
+        self.assertEqual(results['fail'], 'FAIL')
+        if can_import_meson():
+            self.assertEqual(results['xfail'], 'EXPECTEDFAIL')
+        else:
+            # Without the Meson modules should_fail is unknown, which must not go unnoticed
+            self.assertEqual(results['xfail'], 'FAIL')
+            self.assertIn('Tests that should fail are unknown', result.stderr)
+
+
+class UsageErrorTest(TempDirTestCase):
+    """
+    Class that checks invalid options are reported as usage errors.
+    """
+
+    def test_invalid_profiling_format(self):
+        result = run_mcw(['--profiling-format=bogus', '.'], self.dir)
+        self.assertEqual(result.returncode, 1, result.stdout)
+        self.assertIn('Invalid format specified for --profiling-format: bogus', result.stdout)
+        self.assertNotIn('Traceback', result.stdout)
+        self.assertFalse(os.path.exists(self.path('mcw-trace.json')))
+
+
+class TimeTest(TempDirTestCase):
+    """
+    Class that checks -E time reports the command and exits with its status.
+    """
+
+    def test_exit_status(self):
+        result = run_mcw(['-E', 'time', sys.executable, '-c', 'import sys; sys.exit(3)'], self.dir)
+        self.assertEqual(result.returncode, 3, result.stdout)
+        self.assertIn('Elapsed time: ', result.stdout)
+
+    @unittest.skipIf(os.name == 'nt', 'Signals are only reported on Unix')
+    def test_signal(self):
+        result = run_mcw(['-E', 'time', sys.executable, '-c', 'import os, signal; os.kill(os.getpid(), signal.SIGTERM)'],
+                         self.dir)
+        self.assertEqual(result.returncode, 128 + 15, result.stdout)
+
+    @unittest.skipUnless(hasattr(os, 'wait4'), 'Resource usage is only reported on Unix')
+    def test_usage(self):
+        result = run_mcw(['-E', 'time', sys.executable, '-c', 'data = bytearray(200 * 1024 * 1024); sum(range(10 ** 6))'],
+                         self.dir)
+        self.assertEqual(result.returncode, 0, result.stdout)
+        max_rss = int(result.stdout.split(' KiB (max rss)')[0].rsplit(' ', 1)[1])
+        self.assertGreater(max_rss, 200 * 1024)
+        self.assertLess(max_rss, 400 * 1024)
+
+
+class SavePickleTest(TempDirTestCase):
+    """
+    Class that checks pickles shared by mcw processes are replaced atomically.
+    """
+
+    def test_failed_write_keeps_previous(self):
+        from mcw.util import save_pickle, load_pickle
+        path = self.path('cache.pk1')
+        save_pickle(path, {'key': 'value'})
+        with self.assertRaises(Exception):
+            save_pickle(path, {'key': lambda: None})
+        self.assertEqual(load_pickle(path), {'key': 'value'})
+        self.assertEqual(os.listdir(self.dir), ['cache.pk1'])
+
+
+class CacheEntryTest(unittest.TestCase):
+    """
+    Class that checks parsing of -D cache entries.
+    """
+
+    def setUp(self):
+        from mcw.cmake import CMakeWrapper
+        self.cmake = CMakeWrapper()
+
+    def test_typed_entry(self):
+        self.cmake.parse_cache_entry('-DMCW_VALUE:BOOL=ON')
+        self.assertEqual(self.cmake.cache_entries['MCW_VALUE'][:2], ('ON', 'BOOL'))
+
+    def test_value_with_colon(self):
+        self.cmake.parse_cache_entry('-DMCW_VALUE=c:/path')
+        self.assertEqual(self.cmake.cache_entries['MCW_VALUE'][:2], ('c:/path', 'STRING'))
+
+    def test_subproject_option(self):
+        self.cmake.parse_cache_entry('-DMESON_sub:opt=value')
+        self.cmake.parse_cache_entry('-DMESON_sub:path:STRING=dir')
+        self.assertEqual(self.cmake.meson.options, {'sub:opt': 'value', 'sub:path': 'dir'})
+
+    def test_meson_option_not_cached(self):
+        self.cmake.parse_cache_entry('-DMESON_warning_level=3')
+        self.assertEqual(self.cmake.meson.options, {'warning_level': '3'})
+        self.assertNotIn('MESON_warning_level', self.cmake.cache_entries)
+
+        self.cmake.clear_meson_options()
+        self.assertEqual(self.cmake.meson.options, {})
+
+
+@unittest.skipUnless(HAS_MESON, 'Meson and Ninja are required')
+class MesonOptionTest(TempDirTestCase):
+    """
+    Class that checks MESON_<option> entries are applied once.
+    """
+
+    def get_warning_level(self):
+        with open(self.path('meson-info', 'intro-buildoptions.json')) as file:
+            return {option['name']: option['value'] for option in json.load(file)}['warning_level']
+
+    def test_meson_configure_is_kept(self):
+        source_dir = os.path.join(TEST_DIR, 'simple')
+        result = run_mcw(['-G', 'Ninja', '-DMESON_warning_level=3', source_dir], self.dir)
+        self.assertEqual(result.returncode, 0, result.stdout)
+        self.assertEqual(self.get_warning_level(), '3')
+
+        subprocess.check_call(['meson', 'configure', '-Dwarning_level=2', self.dir], stdout=subprocess.DEVNULL)
+        result = run_mcw(['-G', 'Ninja', source_dir], self.dir)
+        self.assertEqual(result.returncode, 0, result.stdout)
+        self.assertEqual(self.get_warning_level(), '2')
+        self.assertIn('MESON_warning_level:STRING=2', read_file(self.path('CMakeCache.txt')))
+
+    def test_invalid_integer(self):
+        result = run_mcw(['-G', 'Ninja', '-DMESON_backend_max_links=many', os.path.join(TEST_DIR, 'simple')],
+                         self.dir)
+        self.assertEqual(result.returncode, 1, result.stdout)
+        self.assertIn('Invalid value for integer option MESON_backend_max_links: many', result.stdout)
+        self.assertNotIn('Traceback', result.stdout)
+
+
+@unittest.skipUnless(HAS_MESON, 'Meson and Ninja are required')
+class CrossFileTest(TempDirTestCase):
+    """
+    Class that checks a changed MCW_CROSS_FILE sets the build dir up again.
+    """
+
+    def write_cross_file(self, name):
+        write_file(self.path(name + '.ini'), "[binaries]\nc = 'cc'\ncpp = 'c++'\n\n"
+                                             "[built-in options]\ncpp_args = ['-DCROSS_%s']\n\n"
+                                             "[host_machine]\nsystem = 'linux'\ncpu_family = 'x86_64'\n"
+                                             "cpu = 'x86_64'\nendian = 'little'\n" % name.upper())
+
+    def get_cpp_args(self):
+        with open(self.path('build', 'meson-info', 'intro-buildoptions.json')) as file:
+            return {option['name']: option['value'] for option in json.load(file)}['cpp_args']
+
+    def test_changed_cross_file(self):
+        os.mkdir(self.path('build'))
+        source_dir = os.path.join(TEST_DIR, 'simple')
+        for name in ('first', 'second'):
+            self.write_cross_file(name)
+            result = run_mcw(['-G', 'Ninja', '-DMCW_CROSS_FILE=' + self.path(name + '.ini'), source_dir],
+                             self.path('build'))
+            self.assertEqual(result.returncode, 0, result.stdout)
+            self.assertEqual(self.get_cpp_args(), ['-DCROSS_' + name.upper()])
+
+
+def deps_path_record(path, id):
+    path = path.encode()
+    path += b'\0' * (-len(path) % 4)
+    return struct.pack('=I', len(path) + 4) + path + struct.pack('=I', ~id & 0xffffffff)
+
+
+def deps_record(output, mtime, deps):
+    size = 4 + 8 + 4 * len(deps)
+    return struct.pack('=Iiq%di' % len(deps), size | 0x80000000, output, mtime, *deps)
+
+
+@unittest.skipUnless(HAS_NINJA, 'Ninja is required')
+class NinjaDepsTest(TempDirTestCase):
+    """
+    Class that checks parsing of .ninja_deps, including records appended by a running build.
+    """
+
+    def setUp(self):
+        super().setUp()
+        from mcw.meson import Meson
+        from mcw.ninja import NinjaBackend
+        os.mkdir(self.path('meson-private'))
+        meson = Meson()
+        meson.build_dir = self.dir
+        self.backend = NinjaBackend(meson)
+
+    def write_deps(self, data, mode='wb'):
+        with open(self.path('.ninja_deps'), mode) as file:
+            file.write(data)
+
+    def test_incremental(self):
+        records = b''.join([deps_path_record('main.o', 0), deps_path_record('../main.cpp', 1),
+                            deps_path_record('/usr/include/stdio.h', 2), deps_record(0, 1234, [1, 2])])
+        partial = deps_path_record('other.o', 3)
+        self.write_deps(b'# ninjadeps\n' + struct.pack('=i', 4) + records + partial[:6])
+
+        deps = {'main.o': ['../main.cpp', '/usr/include/stdio.h']}
+        self.assertEqual(self.backend.get_deps(), deps)
+        stat = os.stat(self.path('.ninja_deps'))
+        self.assertEqual(self.backend.c_deps[0], (stat.st_ino, stat.st_size))
+
+        # The rest of the incomplete record is parsed with the records after it
+        self.write_deps(partial[6:] + deps_record(3, 1235, [1]) + deps_record(0, 1236, [1]), 'ab')
+        deps = {'main.o': ['../main.cpp'], 'other.o': ['../main.cpp']}
+        self.assertEqual(self.backend.get_deps(), deps)
+
+        # A new backend continues from the parser state kept in meson-private
+        self.backend.c_deps = None
+        self.assertEqual(self.backend.get_deps(), deps)
+
+    def test_unknown_version(self):
+        self.write_deps(b'# ninjadeps\n' + struct.pack('=i', 2) + deps_path_record('main.o', 0))
+        self.assertEqual(self.backend.get_deps(), {})
+
+
+@unittest.skipUnless(HAS_MESON and os.name != 'nt', 'Meson, Ninja and Unix sockets are required')
+class ServerTest(TempDirTestCase):
+    """
+    Class that checks a server session answers the requests IDEs send.
+    """
+
+    HEADER = b'\n[== "CMake Server" ==[\n'
+    FOOTER = b'\n]== "CMake Server" ==]\n'
+
+    def setUp(self):
+        super().setUp()
+        pipe = self.path('pipe')
+        with open(self.path('server.log'), 'w') as log:
+            self.server = subprocess.Popen(MCW + ['-E', 'server', '--experimental', '--pipe=' + pipe], cwd=self.dir,
+                                           stdout=log, stderr=subprocess.STDOUT)
+        self.addCleanup(self.server.wait)
+        self.addCleanup(self.server.kill)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(60)
+        self.addCleanup(self.sock.close)
+        # The pipe exists once the server binds it, it accepts connections once it listens
+        while True:
+            try:
+                self.sock.connect(pipe)
+                break
+            except (FileNotFoundError, ConnectionRefusedError):
+                self.assertIsNone(self.server.poll(), read_file(self.path('server.log')))
+                time.sleep(0.01)
+        self.data = b''
+
+    def recv(self):
+        while self.FOOTER not in self.data:
+            data = self.sock.recv(4096)
+            if not data:
+                self.fail('Server closed the connection:\n' + read_file(self.path('server.log')))
+            self.data += data
+        message, self.data = self.data.split(self.FOOTER, 1)
+        return json.loads(message.split(self.HEADER, 1)[1].decode())
+
+    def request(self, type, **fields):
+        fields['type'] = type
+        self.sock.sendall(self.HEADER + json.dumps(fields).encode() + self.FOOTER)
+        while True:
+            message = self.recv()
+            if message['type'] in ('reply', 'error') and message['inReplyTo'] == type:
+                self.assertEqual(message['type'], 'reply', message)
+                return message
+
+    def test_session(self):
+        self.assertEqual(self.recv()['type'], 'hello')
+        self.request('handshake', protocolVersion={'major': 1}, buildDirectory=self.dir, generator='Ninja',
+                     sourceDirectory=os.path.join(TEST_DIR, 'simple'))
+        self.request('configure', cacheArguments=['-DCMAKE_BUILD_TYPE=Debug'])
+        self.request('compute')
+        self.request('globalSettings')
+        inputs = self.request('cmakeInputs')
+        self.assertTrue(inputs['buildFiles'])
+        self.assertEqual(inputs['cmakeRootDirectory'], '/usr/share/cmake')
+        self.assertTrue(self.request('cache')['cache'])
+        targets = self.request('codemodel')['configurations'][0]['projects'][0]['targets']
+        self.assertIn('simple', [target['name'] for target in targets])
+        self.request('ctestInfo')
+
+    def test_ctest_info(self):
+        source_dir = self.path('source')
+        write_file(os.path.join(source_dir, 'meson.build'),
+                   "project('ctests', 'cpp')\n"
+                   "unit = executable('unit', 'unit.cpp')\n"
+                   "test('unit', unit, suite : 'fast', env : {'MCW' : '1'})\n"
+                   "test('shell', find_program('sh'), args : ['-c', 'exit 1'], should_fail : true, is_parallel : false)\n")
+        write_file(os.path.join(source_dir, 'CMakeLists.txt'), '')
+        write_file(os.path.join(source_dir, 'unit.cpp'), 'int main() { return 0; }\n')
+        self.assertEqual(self.recv()['type'], 'hello')
+        self.request('handshake', protocolVersion={'major': 1}, buildDirectory=self.dir, generator='Ninja',
+                     sourceDirectory=source_dir)
+        self.request('configure', cacheArguments=[])
+        self.request('compute')
+
+        configurations = self.request('ctestInfo')['configurations']
+        self.assertEqual(len(configurations), 1)
+        targets = configurations[0]['projects'][0]['targets']
+        self.assertEqual([target['name'] for target in targets], ['unit', 'test'])
+        unit, shell = targets[0]['ctestInfo'][0], targets[1]['ctestInfo'][0]
+        self.assertEqual(unit['ctestName'], 'unit')
+        self.assertTrue(unit['ctestCommand'].endswith('unit'), unit)
+        properties = {prop['key']: prop['value'] for prop in unit['properties']}
+        self.assertEqual(properties['WORKING_DIRECTORY'], self.dir)
+        self.assertIn('fast', properties['LABELS'])
+        self.assertEqual(properties['ENVIRONMENT'], 'MCW=1')
+        self.assertEqual(shell['ctestName'], 'shell')
+        properties = {prop['key']: prop['value'] for prop in shell['properties']}
+        self.assertEqual(properties['RUN_SERIAL'], 'TRUE')
+        if can_import_meson():
+            # should_fail is only known when the test setup of Meson can be loaded
+            self.assertEqual(properties['WILL_FAIL'], 'TRUE')
+
+    def test_subproject_projects(self):
+        source_dir = self.path('source')
+        bar_dir = os.path.join('subprojects', 'bar-1.0')
+        write_file(os.path.join(source_dir, 'meson.build'),
+                   "project('foo', 'cpp')\n"
+                   "bar = subproject('bar')\n"
+                   "executable('foo', 'foo.cpp', link_with : bar.get_variable('lib'))\n")
+        write_file(os.path.join(source_dir, 'CMakeLists.txt'), '')
+        write_file(os.path.join(source_dir, 'foo.cpp'), 'int main() { return 0; }\n')
+        # The subproject dir of a wrap is named after its version
+        write_file(os.path.join(source_dir, 'subprojects', 'bar.wrap'), '[wrap-file]\ndirectory = bar-1.0\n')
+        write_file(os.path.join(source_dir, bar_dir, 'meson.build'),
+                   "project('bar', 'cpp')\nlib = static_library('bar', 'bar.cpp')\n")
+        write_file(os.path.join(source_dir, bar_dir, 'bar.cpp'), 'int bar() { return 0; }\n')
+        self.assertEqual(self.recv()['type'], 'hello')
+        self.request('handshake', protocolVersion={'major': 1}, buildDirectory=self.dir, generator='Ninja',
+                     sourceDirectory=source_dir)
+        self.request('configure', cacheArguments=[])
+        self.request('compute')
+
+        projects = self.request('codemodel')['configurations'][0]['projects']
+        self.assertEqual([project['name'] for project in projects], ['foo', 'bar'])
+        self.assertEqual(projects[1]['sourceDirectory'], os.path.join(source_dir, bar_dir))
+        self.assertEqual(projects[1]['buildDirectory'], os.path.join(self.dir, bar_dir))
+        self.assertEqual([target['name'] for target in projects[0]['targets']], ['foo'])
+        self.assertEqual([target['name'] for target in projects[1]['targets']], ['bar'])
+        self.assertTrue(projects[1]['targets'][0]['fileGroups'])
+
+        self.request('configure', cacheArguments=['-DMCW_SKIP_SUBPROJECT_FILES=ON'])
+        self.request('compute')
+        projects = self.request('codemodel')['configurations'][0]['projects']
+        self.assertTrue(projects[0]['targets'][0]['fileGroups'])
+        self.assertEqual(projects[1]['targets'][0]['fileGroups'], [])
+
+    def test_configure_all_configurations(self):
+        build_dir = self.path('build')
+        os.mkdir(build_dir)
+        self.assertEqual(self.recv()['type'], 'hello')
+        self.request('handshake', protocolVersion={'major': 1}, buildDirectory=build_dir, generator='Ninja',
+                     sourceDirectory=os.path.join(TEST_DIR, 'simple'))
+        self.request('configure', cacheArguments=['-DCMAKE_CONFIGURATION_TYPES=Debug;Release',
+                                                  '-DCMAKE_BUILD_TYPE=Debug'])
+        self.request('compute')
+        self.request('configure', cacheArguments=['-DMESON_warning_level=3'])
+        for build_dir in (build_dir, build_dir + '-Release'):
+            with open(os.path.join(build_dir, 'meson-info', 'intro-buildoptions.json')) as file:
+                self.assertEqual({option['name']: option['value'] for option in json.load(file)}['warning_level'], '3')
+
+
+@unittest.skipUnless(HAS_MESON, 'Meson and Ninja are required')
+class TargetNameTest(TempDirTestCase):
+    """
+    Class that checks targets sharing a name in different directories are told apart.
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.source_dir = self.path('source')
+        write_file(os.path.join(self.source_dir, 'meson.build'), "project('names', 'cpp')\nsubdir('a')\nsubdir('b')\n")
+        write_file(os.path.join(self.source_dir, 'CMakeLists.txt'), '')
+        for dir in ('a', 'b'):
+            write_file(os.path.join(self.source_dir, dir, 'meson.build'), "executable('tool', '%s.cpp')\n" % dir)
+            write_file(os.path.join(self.source_dir, dir, dir + '.cpp'),
+                       '#include "%s_config.h"\nint main() { return 0; }\n' % dir)
+            write_file(os.path.join(self.source_dir, dir, dir + '_config.h'), '')
+        self.build_dir = self.path('build')
+        os.mkdir(self.build_dir)
+        result = run_mcw(['-G', 'CodeBlocks - Ninja', self.source_dir], self.build_dir)
+        self.assertEqual(result.returncode, 0, result.stdout)
+
+    def test_codeblocks_targets(self):
+        project = ETree.parse(os.path.join(self.build_dir, 'names.cbp')).getroot().find('Project')
+        commands = {}
+        for target in project.find('Build').findall('Target'):
+            commands[target.get('title')] = target.find('MakeCommands').find('Build').get('command')
+        self.assertEqual(len(commands), 3)
+        self.assertNotIn('tool', commands)
+        builds = sorted(command.split()[-1] for title, command in commands.items() if title != 'all')
+        self.assertEqual(builds, [os.path.join('a', 'tool'), os.path.join('b', 'tool')])
+
+        units = {os.path.basename(unit.get('filename')): [option.get('target') for option in unit.findall('Option')]
+                 for unit in project.findall('Unit')}
+        self.assertNotEqual(units['a.cpp'], units['b.cpp'])
+        self.assertEqual(set(units['a.cpp'] + units['b.cpp']), set(commands) - {'all'})
+
+    def test_codeblocks_headers(self):
+        result = run_mcw(['--build', '.'], self.build_dir)
+        self.assertEqual(result.returncode, 0, result.stdout)
+        result = run_mcw(['-G', 'CodeBlocks - Ninja', self.source_dir], self.build_dir)
+        self.assertEqual(result.returncode, 0, result.stdout)
+
+        project = ETree.parse(os.path.join(self.build_dir, 'names.cbp')).getroot().find('Project')
+        units = {os.path.basename(unit.get('filename')): [option.get('target') for option in unit.findall('Option')]
+                 for unit in project.findall('Unit')}
+        self.assertEqual(units['a_config.h'], units['a.cpp'])
+        self.assertEqual(units['b_config.h'], units['b.cpp'])
+
+    def test_ambiguous_build_target(self):
+        result = run_mcw(['--build', '.', '--target', 'tool'], self.build_dir)
+        self.assertEqual(result.returncode, 1, result.stdout)
+        self.assertIn('Ambiguous target: "tool"', result.stdout)
+        self.assertFalse(os.path.exists(os.path.join(self.build_dir, 'a', 'tool')))
+
+
+class ToolCacheTest(BuildDirTestCase):
+    """
+    Class that checks -E tools working on a build dir leave its cache entries alone.
+    """
+
+    def test_compile_file(self):
+        cache = self.load_cache()
+        self.assertIn('CMAKE_GENERATOR', cache)
+
+        result = run_mcw(['-E', 'compile_file', os.path.join(TEST_DIR, 'simple', 'main.cpp'), self.dir], self.dir)
+        self.assertEqual(result.returncode, 0, result.stdout)
+        self.assertTrue(os.path.exists(self.path('simple.p', 'main.cpp.o')))
+        self.assertEqual(self.load_cache(), cache)
+        self.build()
+
+    def test_empty_cache_is_initialized(self):
+        # Earlier versions left an empty cache behind after -E tools
+        from mcw.util import save_pickle
+        save_pickle(self.path('cmake-cache.pk1'), {})
+        result = run_mcw(['-G', 'Ninja', os.path.join(TEST_DIR, 'simple')], self.dir)
+        self.assertEqual(result.returncode, 0, result.stdout)
+        self.assertIn('CMAKE_GENERATOR', self.load_cache())
+        self.assertIn('CMAKE_GENERATOR:INTERNAL=Ninja', read_file(self.path('CMakeCache.txt')))
+        self.build()
+
+
+def write_ninja_log(path, steps):
+    """
+    Replace a .ninja_log with (start, end, output) steps, like Ninja does when recompacting it.
+    """
+    content = '# ninja log v5\n'
+    for start, end, output in steps:
+        content += '%d\t%d\t0\t%s\t%x\n' % (start, end, output, hash(output) & 0xffffffff)
+    write_file(path + '.tmp', content)
+    os.replace(path + '.tmp', path)
+
+
+class BuildReportTest(BuildDirTestCase):
+    """
+    Class that checks -E build_report on a .ninja_log with known step times.
+    """
+
+    def build_report(self, *args):
+        result = run_mcw(['-E', 'build_report', '--json'] + list(args) + [self.dir], self.dir)
+        self.assertEqual(result.returncode, 0, result.stdout)
+        return json.loads(result.stdout)
+
+    def test_report(self):
+        write_ninja_log(self.path('.ninja_log'), [(0, 1500, 'simple.p/main.cpp.o'), (1500, 1700, 'simple')])
+        report = self.build_report()
+        self.assertEqual(report['duration'], 1700)
+        self.assertEqual(report['targets'], [{'name': 'simple', 'duration': 1700, 'steps': 2}])
+        self.assertEqual(report['units'], [{'output': 'simple.p/main.cpp.o', 'target': 'simple', 'duration': 1500}])
+        self.assertEqual([step['output'] for step in report['criticalPath']], ['simple.p/main.cpp.o', 'simple'])
+
+    def test_baseline_regressions(self):
+        write_ninja_log(self.path('.ninja_log'), [(0, 1500, 'simple.p/main.cpp.o'), (1500, 1700, 'simple')])
+        self.build_report('--save-baseline', self.path('baseline.json'))
+
+        # Only the object got slower by more than the thresholds
+        write_ninja_log(self.path('.ninja_log'), [(0, 3000, 'simple.p/main.cpp.o'), (3000, 3250, 'simple')])
+        report = self.build_report('--baseline', self.path('baseline.json'))
+        self.assertEqual(sorted((regression['kind'], regression['name'], regression['baseline'],
+                                 regression['duration']) for regression in report['regressions']),
+                         [('target', 'simple', 1700, 3250), ('unit', 'simple.p/main.cpp.o', 1500, 3000)])
+
+        result = run_mcw(['-E', 'build_report', '--baseline', self.path('baseline.json'), self.dir], self.dir)
+        self.assertIn('Regressions against baseline:', result.stdout)
+
+    def test_keeps_cache(self):
+        self.build()
+        cache = self.load_cache()
+        result = run_mcw(['-E', 'build_report', self.dir], self.dir)
+        self.assertEqual(result.returncode, 0, result.stdout)
+        self.assertIn('Build time by target', result.stdout)
+        self.assertEqual(self.load_cache(), cache)
+        self.build()
+
+
+@unittest.skipUnless(HAS_NINJA, 'Ninja is required')
+class NinjaLogTest(TempDirTestCase):
+    """
+    Class that checks incremental parsing of .ninja_log.
+    """
+
+    def setUp(self):
+        super().setUp()
+        from mcw.meson import Meson
+        from mcw.ninja import NinjaBackend
+        os.mkdir(self.path('meson-private'))
+        meson = Meson()
+        meson.build_dir = self.dir
+        self.backend = NinjaBackend(meson)
+        self.log_file = self.path('.ninja_log')
+
+    def test_appended_builds(self):
+        write_ninja_log(self.log_file, [(0, 100, 'a.o'), (100, 200, 'a')])
+        self.assertEqual({output: entry[3] for output, entry in self.backend.get_log_entries().items()},
+                         {'a.o': 0, 'a': 0})
+
+        # Times restart with the next Ninja invocation, an incomplete last line is left for later
+        with open(self.log_file, 'a') as file:
+            file.write('0\t50\t0\tb.o\t1\n10\t20\t0\tc')
+        entries = self.backend.get_log_entries()
+        self.assertEqual({output: entry[3] for output, entry in entries.items()}, {'a.o': 0, 'a': 0, 'b.o': 1})
+        self.assertEqual(entries['b.o'][:2], (0, 50))
+
+    def test_recompaction_restarts(self):
+        write_ninja_log(self.log_file, [(0, 100, 'a.o'), (100, 200, 'a'), (0, 100, 'b.o')])
+        self.assertEqual(len(self.backend.get_log_entries()), 3)
+
+        # Ninja writes a recompacted log to a new file, which is parsed from the start
+        write_ninja_log(self.log_file, [(0, 300, 'b.o')])
+        entries = self.backend.get_log_entries()
+        self.assertEqual(list(entries), ['b.o'])
+        self.assertEqual(entries['b.o'][:2], (0, 300))
+
+
+class ChecksumTest(TempDirTestCase):
+    """
+    Class that checks -E <algorithm>sum prints checksums like coreutils.
+    """
+
+    def test_checksums(self):
+        from mcw.util import CHUNK_SIZE
+        contents = {'small': b'mcw\n', 'large': os.urandom(2 * CHUNK_SIZE + 1), 'empty': b''}
+        for name, content in contents.items():
+            with open(self.path(name), 'wb') as file:
+                file.write(content)
+
+        for algorithm in ('md5', 'sha1', 'sha224', 'sha256', 'sha384', 'sha512'):
+            result = run_mcw(['-E', algorithm + 'sum'] + sorted(contents), self.dir)
+            self.assertEqual(result.returncode, 0, result.stdout)
+            self.assertEqual(result.stdout.splitlines(), ['%s  %s' % (hashlib.new(algorithm, contents[name]).hexdigest(),
+                                                                      name) for name in sorted(contents)])
+
+    def test_missing_file(self):
+        write_file(self.path('file'), 'mcw\n')
+        result = run_mcw(['-E', 'md5sum', 'missing', 'file'], self.dir)
+        self.assertEqual(result.returncode, 1, result.stdout)
+        self.assertIn('Error: missing: ', result.stdout)
+        self.assertIn('%s  file' % hashlib.md5(b'mcw\n').hexdigest(), result.stdout)
+
+
+class CopyIfDifferentTest(TempDirTestCase):
+    """
+    Class that checks -E copy_if_different only writes changed files.
+    """
+
+    def test_equal_file_is_kept(self):
+        write_file(self.path('source'), 'mcw\n')
+        write_file(self.path('destination'), 'mcw\n')
+        os.utime(self.path('destination'), (1000000000, 1000000000))
+        result = run_mcw(['-E', 'copy_if_different', 'source', 'destination'], self.dir)
+        self.assertEqual(result.returncode, 0, result.stdout)
+        self.assertEqual(os.stat(self.path('destination')).st_mtime, 1000000000)
+
+    def test_different_files_are_copied(self):
+        write_file(self.path('a'), 'a\n')
+        write_file(self.path('b'), 'b\n')
+        write_file(self.path('dir', 'a'), 'old\n')
+        write_file(self.path('dir', 'b'), 'b\n')
+        os.utime(self.path('dir', 'b'), (1000000000, 1000000000))
+        result = run_mcw(['-E', 'copy_if_different', 'a', 'b', 'dir'], self.dir)
+        self.assertEqual(result.returncode, 0, result.stdout)
+        self.assertEqual(read_file(self.path('dir', 'a')), 'a\n')
+        self.assertEqual(os.stat(self.path('dir', 'b')).st_mtime, 1000000000)
+
+    def test_errors(self):
+        write_file(self.path('a'), 'a\n')
+        result = run_mcw(['-E', 'copy_if_different', 'a', 'a', 'file'], self.dir)
+        self.assertEqual(result.returncode, 1, result.stdout)
+        self.assertIn('Target (for copy_if_different command) "file" is not a directory.', result.stdout)
+
+        result = run_mcw(['-E', 'copy_if_different', 'missing', 'file'], self.dir)
+        self.assertEqual(result.returncode, 1, result.stdout)
+        self.assertIn('Error copying file (if different) from "missing" to "file".', result.stdout)
+
+
+class TarTest(TempDirTestCase):
+    """
+    Class that checks -E tar creates, lists and extracts tar and zip archives.
+    """
+
+    def setUp(self):
+        super().setUp()
+        from mcw.util import CHUNK_SIZE
+        write_file(self.path('data', 'a.txt'), 'a\n')
+        self.large = os.urandom(2 * CHUNK_SIZE + 1)
+        os.makedirs(self.path('data', 'sub'))
+        with open(self.path('data', 'sub', 'b.bin'), 'wb') as file:
+            file.write(self.large)
+        os.mkdir(self.path('out'))
+
+    def check_archive(self, archive, flags='cf', *options):
+        result = run_mcw(['-E', 'tar', flags, archive] + list(options) + ['data'], self.dir)
+        self.assertEqual(result.returncode, 0, result.stdout)
+
+        result = run_mcw(['-E', 'tar', 'tf', archive], self.dir)
+        self.assertEqual(result.returncode, 0, result.stdout)
+        self.assertEqual(sorted(name.rstrip('/') for name in result.stdout.splitlines()),
+                         ['data', 'data/a.txt', 'data/sub', 'data/sub/b.bin'])
+
+        result = run_mcw(['-E', 'tar', 'xf', os.path.join('..', archive)], self.path('out'))
+        self.assertEqual(result.returncode, 0, result.stdout)
+        self.assertEqual(read_file(self.path('out', 'data', 'a.txt')), 'a\n')
+        with open(self.path('out', 'data', 'sub', 'b.bin'), 'rb') as file:
+            self.assertEqual(file.read(), self.large)
+
+    def test_tar(self):
+        self.check_archive('data.tar')
+
+    def test_compressed_tar(self):
+        self.check_archive('data.tar.gz', 'czf')
+
+    def test_zip(self):
+        self.check_archive('data.zip', 'cf', '--format=zip')
+
+    def test_selected_members(self):
+        result = run_mcw(['-E', 'tar', 'cf', 'data.tar', 'data'], self.dir)
+        self.assertEqual(result.returncode, 0, result.stdout)
+        result = run_mcw(['-E', 'tar', 'xf', os.path.join('..', 'data.tar'), 'data/sub'], self.path('out'))
+        self.assertEqual(result.returncode, 0, result.stdout)
+        self.assertFalse(os.path.exists(self.path('out', 'data', 'a.txt')))
+        self.assertTrue(os.path.exists(self.path('out', 'data', 'sub', 'b.bin')))
+
+    def test_errors(self):
+        result = run_mcw(['-E', 'tar', 'czjf', 'data.tar', 'data'], self.dir)
+        self.assertEqual(result.returncode, 1, result.stdout)
+        self.assertIn('Can only compress a tar file one way', result.stdout)
+        write_file(self.path('bad.tar'), 'not an archive\n')
+        result = run_mcw(['-E', 'tar', 'xf', 'bad.tar'], self.dir)
+        self.assertEqual(result.returncode, 1, result.stdout)
+        self.assertIn('Error: tar: ', result.stdout)
+
+
+class CompareFilesTest(TempDirTestCase):
+    """
+    Class that checks -E compare_files reports equal, different and missing files.
+    """
+
+    def write_binary(self, name, content):
+        with open(self.path(name), 'wb') as file:
+            file.write(content)
+
+    def compare(self, *args):
+        return run_mcw(['-E', 'compare_files'] + list(args), self.dir)
+
+    def test_compare(self):
+        from mcw.util import CHUNK_SIZE
+        content = os.urandom(2 * CHUNK_SIZE + 1)
+        self.write_binary('a', content)
+        self.write_binary('b', content)
+        self.write_binary('c', content[:-1] + bytes([content[-1] ^ 1]))
+        self.write_binary('empty', b'')
+        self.write_binary('empty2', b'')
+        self.assertEqual(self.compare('a', 'b').returncode, 0)
+        self.assertEqual(self.compare('empty', 'empty2').returncode, 0)
+        result = self.compare('a', 'c')
+        self.assertEqual(result.returncode, 1, result.stdout)
+        self.assertIn('Files "a" to "c" are different.', result.stdout)
+        self.assertEqual(self.compare('a', 'empty').returncode, 1)
+        self.assertEqual(self.compare('a', 'missing').returncode, 2)
+
+    def test_ignore_eol(self):
+        self.write_binary('unix', b'a\nb\n')
+        self.write_binary('windows', b'a\r\nb\r\n')
+        self.write_binary('other', b'a\r\nc\r\n')
+        self.assertEqual(self.compare('unix', 'windows').returncode, 1)
+        self.assertEqual(self.compare('--ignore-eol', 'unix', 'windows').returncode, 0)
+        self.assertEqual(self.compare('--ignore-eol', 'unix', 'other').returncode, 1)
+
+
+class RemoveDirectoryTest(TempDirTestCase):
+    """
+    Class that checks -E remove_directory removes trees, but not the targets of links.
+    """
+
+    def test_remove_tree(self):
+        for dir in ('a', 'b'):
+            for i in range(10):
+                write_file(self.path(dir, 'sub%d' % i, 'nested', 'file'), 'mcw\n')
+        result = run_mcw(['-E', 'remove_directory', 'a', 'b', 'missing'], self.dir)
+        self.assertEqual(result.returncode, 0, result.stdout)
+        self.assertEqual(os.listdir(self.dir), [])
+
+    @unittest.skipIf(os.name == 'nt', 'Symbolic links need privileges on Windows')
+    def test_link_to_directory(self):
+        write_file(self.path('target', 'file'), 'mcw\n')
+        os.symlink('target', self.path('link'))
+        result = run_mcw(['-E', 'remove_directory', 'link'], self.dir)
+        self.assertEqual(result.returncode, 0, result.stdout)
+        self.assertFalse(os.path.lexists(self.path('link')))
+        self.assertTrue(os.path.exists(self.path('target', 'file')))
+
+
+class BatchTest(TempDirTestCase):
+    """
+    Class that checks -E batch runs tool commands in order and stops at the first failure.
+    """
+
+    def test_commands(self):
+        write_file(self.path('commands.txt'), '# Set up a directory\n'
+                                              'make_directory dir\n'
+                                              '\n'
+                                              '-E touch "dir/a file"  # quoted\n'
+                                              'echo batch\n'
+                                              'chdir dir "%s" -c "open(\'child\', \'w\').close()"\n'
+                                              'touch last\n' % sys.executable)
+        result = run_mcw(['-E', 'batch', 'commands.txt'], self.dir)
+        self.assertEqual(result.returncode, 0, result.stdout)
+        self.assertEqual(result.stdout, 'batch\n')
+        for path in (('dir', 'a file'), ('dir', 'child'), ('last',)):
+            self.assertTrue(os.path.exists(self.path(*path)), path)
+
+    def test_stops_at_failure(self):
+        write_file(self.path('a'), 'a\n')
+        write_file(self.path('b'), 'b\n')
+        result = subprocess.run(MCW + ['-E', 'batch', '-'], cwd=self.dir, stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT, universal_newlines=True,
+                                input='touch first\ncompare_files a b\ntouch last\n')
+        self.assertEqual(result.returncode, 1, result.stdout)
+        self.assertIn('Files "a" to "b" are different.', result.stdout)
+        self.assertTrue(os.path.exists(self.path('first')))
+        self.assertFalse(os.path.exists(self.path('last')))
+
+    def test_child_exit_status(self):
+        write_file(self.path('commands.txt'), 'chdir . "%s" -c "import sys; sys.exit(3)"\ntouch last\n'
+                   % sys.executable)
+        result = run_mcw(['-E', 'batch', 'commands.txt'], self.dir)
+        self.assertEqual(result.returncode, 3, result.stdout)
+        self.assertFalse(os.path.exists(self.path('last')))
+
+
+if __name__ == '__main__':
+    unittest.main()